@@ -24,9 +24,11 @@ from .latent_preview import prepare_callback, get_previewer
 from .model_patcher.teacache import patch_teacache
 from .model_patcher.patch import patch_cfg_zero_star, patch_enhance_video, skip_layer_guidance, CFGGuider2
 from .model_patcher.optimization import patch_sage_attention, patch_model_order, torch_compile_model
+from .model_patcher.offload import offload_module
 from .dataclass import Config
 from comfy_extras.nodes_custom_sampler import Noise_EmptyNoise, Noise_RandomNoise
-from .gguf.nodes import load_gguf
+from .gguf.nodes import load_gguf, load_gguf_clip
+from .gguf.loader import get_split_names, is_split_part
 
 from spandrel import ModelLoader, ImageModelDescriptor
 from torch.hub import download_url_to_file
@@ -46,6 +48,7 @@ def update_folder_names_and_paths(key, targets=[]):
 
 # Add a custom keys for files ending in .gguf
 update_folder_names_and_paths("unet_gguf", ["diffusion_models", "unet"])
+update_folder_names_and_paths("clip_gguf", ["text_encoders", "clip"])
 
 def add_model_list_from_huggingface(repo_id, filters, ignore_filters=None):
     from huggingface_hub import HfApi
@@ -72,11 +75,12 @@ try:
     if not REPO_ID_MODELS:
         raise ValueError("Failed to fetch model list.")
     else:
-        MODEL_LIST = [k for k in REPO_ID_MODELS.keys()]
+        # split GGUF sets are listed once, by their first part
+        MODEL_LIST = [k for k in REPO_ID_MODELS.keys() if not is_split_part(k)]
 
 except Exception as e:
     print(e)
-    MODEL_LIST = folder_paths.get_filename_list("unet_gguf")
+    MODEL_LIST = [k for k in folder_paths.get_filename_list("unet_gguf") if not is_split_part(k)]
 
 CLIP_NAME = "umt5_xxl_fp8_e4m3fn_scaled.safetensors"
 CLIP_VISION_NAME = "clip_vision_h.safetensors"
@@ -88,6 +92,11 @@ intermediate_device = mm.intermediate_device()
 offload_device = mm.unet_offload_device()
 torch_device = mm.get_torch_device()
 
+def offload_encoder(model):
+    if WanVideoModelLoader_F2.host_arena:
+        return offload_module(model, offload_device)
+    return model.to(offload_device)
+
 def convert_filename_comfyorg(model_type, model_name):
     return f"split_files/{model_type}/{model_name}"
 
@@ -161,6 +170,9 @@ class WanVideoModelLoader_F2:
         "taehv": None,
     }
     loaded_model = None
+    loaded_options = None
+    host_arena = False
+    text_encoder = "default"
     loaded_loras = {
         "lora_1": None,
         "lora_2": None,
@@ -173,12 +185,23 @@ class WanVideoModelLoader_F2:
     @classmethod
     def INPUT_TYPES(s):
         lora_files = ["disabled"] + folder_paths.get_filename_list("loras")
+        text_encoder_files = ["default"] + [x for x in folder_paths.get_filename_list("clip_gguf") if x.endswith(".gguf")]
         return {
             "required":{
                 "unet_name": (MODEL_LIST, ),
                 "lora_1": (lora_files, {"advanced": True}), "lora_1_strength": ("FLOAT", {"default": 1.00, "min": -10.00, "max": 10.00, "step":0.01, "round": 0.01, "advanced": True}),
                 "lora_2": (lora_files, {"advanced": True}), "lora_2_strength": ("FLOAT", {"default": 1.00, "min": -10.00, "max": 10.00, "step":0.01, "round": 0.01, "advanced": True}),
                 "lora_3": (lora_files, {"advanced": True}), "lora_3_strength": ("FLOAT", {"default": 1.00, "min": -10.00, "max": 10.00, "step":0.01, "round": 0.01, "advanced": True}),
+                "dequant_cache_mb": ("INT", {"default": 0, "min": 0, "max": 65536, "step": 256, "tooltip": "GGUF only. VRAM budget for keeping dequantized weights between steps, 0 disables the cache.", "advanced": True}),
+                "dequant_tile_rows": ("INT", {"default": 0, "min": 0, "max": 16384, "step": 256, "tooltip": "GGUF only. Dequantize linear weights this many rows at a time to lower peak memory, 0 dequantizes the full weight. Weights that fit dequant_cache_mb are kept whole in that cache instead of being tiled.", "advanced": True}),
+                "prefetch_blocks": ("INT", {"default": 0, "min": 0, "max": 4, "tooltip": "GGUF only. Dequantize this many upcoming transformer blocks on a background thread while the current block runs, 0 disables prefetching.", "advanced": True}),
+                "repack_cache": (["disabled", "requant_q8_0", "fp16"], {"default": "disabled", "tooltip": "GGUF only. Keep a repacked copy of the model on disk that is faster to load and to dequantize. requant_q8_0 re-quantizes every weight that is not already Q8_0, so the outputs differ from the source GGUF and Q4/Q5 models about double in size (~1.06 bytes per weight). fp16 stores the dequantized weights (2 bytes per weight).", "advanced": True}),
+                "quantize_on_load": (["disabled", "Q8_0", "Q6_K", "Q4_K"], {"default": "disabled", "tooltip": "Safetensors (fp16/bf16) only. Quantize the transformer block weights to this GGML type while loading, the GGUF options above then apply as well. Q6_K/Q4_K search their scales like llama.cpp's quantizer without an importance matrix, so they are close to but not as good as imatrix GGUF downloads, and the search takes a while (on the GPU).", "advanced": True}),
+                "lora_mode": (["merge", "side"], {"default": "merge", "tooltip": "GGUF only. merge adds the LoRA delta to each dequantized weight, side keeps plain LoRAs low rank and adds their output next to the layer (LoCon/DoRA still merge).", "advanced": True}),
+                "stream_blocks": ("INT", {"default": 0, "min": 0, "max": 8, "tooltip": "GGUF only. Keep offloaded weights backed by the model file instead of copying them to RAM, reading this many blocks ahead and releasing blocks once they ran. 0 disables streaming.", "advanced": True}),
+                "memory_planner": ("BOOLEAN", {"default": False, "tooltip": "GGUF only. Decide how many transformer blocks stay in VRAM from the per-layer weight, dequant, LoRA and activation sizes for the configured resolution and frames instead of ComfyUI's estimate.", "advanced": True}),
+                "host_arena": ("BOOLEAN", {"default": False, "tooltip": "Keep offloaded weights (text encoder, clip vision, vae and the GGUF weights released from the model file) in one pinned host buffer. Offloading then only re-points the weights instead of copying them back.", "advanced": True}),
+                "text_encoder": (text_encoder_files, {"default": "default", "tooltip": "default downloads the fp8 UMT5 text encoder. A GGUF UMT5 from the text_encoders folder keeps its token embedding quantized and only dequantizes the rows a prompt looks up, its tokenizer is rebuilt once and cached in models/gguf_cache.", "advanced": True}),
             },
         }
        
@@ -188,16 +211,24 @@ class WanVideoModelLoader_F2:
     CATEGORY = "Flow2/Wan 2.1"
 
     @classmethod
-    def get_clip(cls):
+    def get_clip(cls, text_encoder=None):
+        if text_encoder is not None and text_encoder != cls.text_encoder:
+            cls.text_encoder = text_encoder
+            cls.encoder_models["clip"] = None
         if cls.encoder_models["clip"] is None:
-            path = download_huggingface_model(REPO_ID_COMFYORG, convert_filename_comfyorg("text_encoders", CLIP_NAME), "text_encoders")
-            state_dicts = load_torch_file(path, safe_load=True)
-            clip = load_text_encoder_state_dicts(
-                state_dicts=[state_dicts],
-                clip_type=CLIPType.WAN,
-                model_options={"load_device": torch_device, "offload_device": offload_device} #if clip_offload == "cpu" else {}
-            )
-            del state_dicts
+            model_options = {"load_device": torch_device, "offload_device": offload_device} #if clip_offload == "cpu" else {}
+            if cls.text_encoder != "default":
+                path = folder_paths.get_full_path_or_raise("clip_gguf", cls.text_encoder)
+                clip = load_gguf_clip(path, CLIPType.WAN, model_options)
+            else:
+                path = download_huggingface_model(REPO_ID_COMFYORG, convert_filename_comfyorg("text_encoders", CLIP_NAME), "text_encoders")
+                state_dicts = load_torch_file(path, safe_load=True)
+                clip = load_text_encoder_state_dicts(
+                    state_dicts=[state_dicts],
+                    clip_type=CLIPType.WAN,
+                    model_options=model_options
+                )
+                del state_dicts
             cls.encoder_models["clip"] = clip
 
         return cls.encoder_models["clip"]
@@ -261,22 +292,50 @@ class WanVideoModelLoader_F2:
             lora_1, lora_1_strength,
             lora_2, lora_2_strength,
             lora_3, lora_3_strength,
+            dequant_cache_mb=0,
+            dequant_tile_rows=0,
+            prefetch_blocks=0,
+            repack_cache="disabled",
+            quantize_on_load="disabled",
+            lora_mode="merge",
+            stream_blocks=0,
+            host_arena=False,
+            memory_planner=False,
+            text_encoder="default",
         ):
 
-        if cls.loaded_model is None or cls.loaded_model[0] != unet_name:
+        options = {
+            "dequant_cache_mb": dequant_cache_mb,
+            "dequant_tile_rows": dequant_tile_rows,
+            "prefetch_blocks": prefetch_blocks,
+            "repack_cache": repack_cache,
+            "quantize_on_load": quantize_on_load,
+            "lora_mode": lora_mode,
+            "stream_blocks": stream_blocks,
+            "host_arena": host_arena,
+            "memory_planner": memory_planner,
+        }
+        cls.host_arena = host_arena
+
+        if cls.loaded_model is None or cls.loaded_model[0] != unet_name.lower() or cls.loaded_options != options:
 
             repo_id = REPO_ID_MODELS[unet_name] if unet_name in REPO_ID_MODELS else ""
 
             if repo_id == REPO_ID_COMFYORG:
                 path = download_huggingface_model(REPO_ID_COMFYORG, convert_filename_comfyorg("diffusion_models", unet_name), "diffusion_models")
             else:
-                path = download_huggingface_model(repo_id, unet_name, "diffusion_models")
+                # every part of a split GGUF set, the first one is what gets loaded
+                for part_name in get_split_names(unet_name)[::-1]:
+                    path = download_huggingface_model(repo_id, part_name, "diffusion_models")
 
             unet_name = unet_name.lower()
 
             if "gguf" in unet_name:
                 print("load gguf model...")
-                model = load_gguf(path)
+                model = load_gguf(path, dequant_cache_mb=dequant_cache_mb, tile_rows=dequant_tile_rows, prefetch_blocks=prefetch_blocks, repack_cache=repack_cache, lora_mode=lora_mode, stream_blocks=stream_blocks, host_arena=host_arena, memory_planner=memory_planner)
+            elif quantize_on_load != "disabled" and not any(x in unet_name for x in ("e4m3fn", "e5m2")):
+                print(f"load diffusion model and quantize to {quantize_on_load}...")
+                model = load_gguf(path, dequant_cache_mb=dequant_cache_mb, tile_rows=dequant_tile_rows, prefetch_blocks=prefetch_blocks, quantize=quantize_on_load, lora_mode=lora_mode, host_arena=host_arena, memory_planner=memory_planner)
             else:
                 print("load diffusion model...")
                 model_options = {}
@@ -291,10 +350,11 @@ class WanVideoModelLoader_F2:
                 model = comfy.sd.load_diffusion_model(path, model_options=model_options)
 
             cls.loaded_model = (unet_name, model)
+            cls.loaded_options = options
 
         model = cls.loaded_model[-1]
 
-        WanVideoModelLoader_F2.get_clip()
+        WanVideoModelLoader_F2.get_clip(text_encoder)
         WanVideoModelLoader_F2.get_clip_vision()
         WanVideoModelLoader_F2.get_vae()
         WanVideoModelLoader_F2.get_taehv()
@@ -322,6 +382,8 @@ class WanVideoConfigure_F2:
                 "sampling_steps": ("INT", {"default": 20, "min": 0, "max": 50}),
                 "guidance_percent": ("FLOAT", {"default": 1.00, "min": 0.00, "max": 1.00, "step":0.01, "round": 0.01, "advanced": True}),
                 "enhance_strength": ("FLOAT", {"default": 0.00, "min": 0.00, "max": 10.0, "step":0.01, "round": 0.01, "advanced": True}),
+                "enhance_sample_stride": ("INT", {"default": 1, "min": 1, "max": 16, "tooltip": "Estimate the enhance score from every n-th spatial token and head instead of all of them. On video-like test data strides 2-8 stay within 0.1% of the full score (tests/test_feta_score.py).", "advanced": True}),
+                "enhance_block_stride": ("INT", {"default": 1, "min": 1, "max": 40, "tooltip": "Compute the enhance score in every n-th block only, the blocks in between reuse it within the step. How far that is from each block's own score depends on the model, set FETA_CHECK in model_patcher/patch.py to print it per step.", "advanced": True}),
                 "cfg_zero_steps": (("disabled", "1", "2", "3", "4"), {"advanced": True}),
                 "skip_layer": (("disabled", "9", "10", "9, 10"), {"advanced": True}),
                 "skip_start_percent": ("FLOAT", {"default": 0.1, "min": 0.00, "max": 1.00, "step":0.01, "round": 0.0, "advanced": True}),
@@ -353,6 +415,8 @@ class WanVideoConfigure_F2:
             skip_start_percent,
             skip_end_percent,
             extend_video_count,
+            enhance_sample_stride=1,
+            enhance_block_stride=1,
         ):
         
         WanVideoConfigure_F2.config = Config(
@@ -371,6 +435,8 @@ class WanVideoConfigure_F2:
             skip_start_percent=skip_start_percent,
             skip_end_percent=skip_end_percent,
             extend_video_count=extend_video_count,
+            enhance_sample_stride=enhance_sample_stride,
+            enhance_block_stride=enhance_block_stride,
         )
 
         return (True, width, height, )
@@ -387,8 +453,11 @@ class WanVideoModelPatcher_F2:
                 "model": ("MODEL", ),
                 "patch": ("PATCH", ),
                 "sage_attention": (("disabled", "auto", "triton", ), ),
-                "teacache": (("disabled", "normal", "retention", ), ),
+                "teacache": (("disabled", "normal", "retention", "first_block", "token", "calibrate", ), {"tooltip": "first_block always runs the first block and reuses the cached rest when its residual barely changed, no per-model coefficients needed, and lets cond and uncond skip independently (normal/retention decide from the timestep, which both share). token recomputes only the most changed quarter of the tokens between full steps, for mostly static shots. It keeps every block's keys/values of the last full step on the GPU as attention context, (blocks x 2 x batch x tokens x dim), and runs every step in full when that is over half the free VRAM. calibrate runs without skipping and fits TeaCache coefficients for the loaded model, saved to the user directory and used by normal/retention afterwards."}),
                 "compile_model": (("disabled", "default", ), ),
+                "teacache_residency": (("host", "device", ), {"default": "host", "tooltip": "Where TeaCache keeps the cached residual between steps. device makes skipped steps free of transfers at the cost of VRAM.", "advanced": True}),
+                "teacache_residual_dtype": (("default", "fp16", "fp8", ), {"default": "default", "tooltip": "Store the cached TeaCache residual compressed. fp16 halves and fp8 (scaled) quarters its size and transfers.", "advanced": True}),
+                "teacache_schedule": (("constant", "conservative", "balanced", "aggressive", ), {"default": "constant", "tooltip": "Max consecutive skips and threshold over the run. The presets skip little at the start and end and more in the middle, from conservative (quality) to aggressive (speed).", "advanced": True}),
             }
         }
     
@@ -405,6 +474,9 @@ class WanVideoModelPatcher_F2:
             sage_attention,
             teacache,
             compile_model,
+            teacache_residency="host",
+            teacache_residual_dtype="default",
+            teacache_schedule="constant",
         ):
 
         if not patch:
@@ -433,7 +505,7 @@ class WanVideoModelPatcher_F2:
 
         if config.frames > 0 and config.enhance_strength > 0:
             l = ((config.frames - 1) // 4) + 1
-            model = patch_enhance_video(model, weight=config.enhance_strength, latent_frames=l)
+            model = patch_enhance_video(model, weight=config.enhance_strength, latent_frames=l, sample_stride=config.enhance_sample_stride, block_stride=config.enhance_block_stride)
 
         if config.skip_layer != "disabled":
             model = skip_layer_guidance(model, config.skip_layer, config.skip_start_percent, config.skip_end_percent)
@@ -442,7 +514,7 @@ class WanVideoModelPatcher_F2:
             model = patch_cfg_zero_star(model, int(config.cfg_zero_steps))
 
         if teacache != "disabled":
-            model = patch_teacache(model, WanVideoModelLoader_F2.loaded_model[0], teacache)
+            model = patch_teacache(model, WanVideoModelLoader_F2.loaded_model[0], teacache, teacache_residency, teacache_residual_dtype, teacache_schedule)
 
         if compile_model != "disabled":
             model = torch_compile_model(model, compile_model)
@@ -725,7 +797,7 @@ class WanVideoSampler_F2:
         clip = WanVideoModelLoader_F2.get_clip()
         positive = self.encode_text(clip, config.positive)
         negative = self.encode_text(clip, config.negative)
-        clip.cond_stage_model.to(offload_device)
+        offload_encoder(clip.cond_stage_model)
         clear_cuda_cache()
 
         batch_size = 1
@@ -736,7 +808,7 @@ class WanVideoSampler_F2:
         if args.image_to_video and args.start_image is not None:
             clip_vision = WanVideoModelLoader_F2.get_clip_vision()
             clip_vision_output = self.encode_image(clip_vision, args.start_image)
-            clip_vision.model.to(offload_device)
+            offload_encoder(clip_vision.model)
             clear_cuda_cache()
             
             if args.fun_inpaint and args.end_image is not None:
@@ -744,7 +816,7 @@ class WanVideoSampler_F2:
             else:
                 concat_latent_image, concat_mask = self.encode_image_to_video(args.width, args.height, config.frames, empty_latent["samples"], vae, args.start_image)
 
-            vae.first_stage_model.to(offload_device)
+            offload_encoder(vae.first_stage_model)
             clear_cuda_cache()
 
             positive = conditioning_set_values(positive, {
@@ -782,6 +854,10 @@ class WanVideoSampler_F2:
             return guider
         
         guider = get_cfg_guider2()
+
+        # inputs for the GGUF memory planner
+        if hasattr(args.model, "plan_input"):
+            args.model.plan_input = {"width": args.width, "height": args.height, "frames": config.frames, "batch": 1 if config.guidance_scale == 1.0 else 2}
         
         samples = guider.sample(get_random_noise(), latent_image, sampler, full_sigmas, denoise_mask=noise_mask, callback=preview_callback, disable_pbar=False, seed=args.seed)
 
@@ -815,7 +891,7 @@ class WanVideoSampler_F2:
             print("processing in default vae decode...")
             images = VAEDecode.decode(None, vae, samples=out_denoised)[0]
 
-        vae.first_stage_model.to(offload_device)
+        offload_encoder(vae.first_stage_model)
         clear_cuda_cache()
 
         if args.unload_all_models:
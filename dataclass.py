@@ -16,4 +16,6 @@ class Config:
     skip_layer: str
     skip_start_percent: float
     skip_end_percent: float
-    extend_video_count: int
\ No newline at end of file
+    extend_video_count: int
+    enhance_sample_stride: int = 1
+    enhance_block_stride: int = 1
\ No newline at end of file
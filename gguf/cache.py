@@ -0,0 +1,69 @@
+import weakref
+import threading
+import collections
+
+class DequantCache:
+    """
+    LRU cache for dequantized (and patched) weights with a memory budget
+    """
+    def __init__(self, budget_mb=0):
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, source):
+        with self.lock:
+            entry = self.entries.get(key)
+            # entry is stale if the param or its patch list was swapped out
+            if entry is not None and (entry[0]() is not source or entry[1] is not getattr(source, "patches", None)):
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, source, weight):
+        size = weight.numel() * weight.element_size()
+        if size > self.budget:
+            return weight
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            while self.entries and self.used + size > self.budget:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[key] = (weakref.ref(source), getattr(source, "patches", None), weight)
+            self.used += size
+        return weight
+
+    def _drop(self, key):
+        weight = self.entries.pop(key)[2]
+        self.used -= weight.numel() * weight.element_size()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.entries),
+            "used_mb": self.used / (1024 * 1024),
+            "budget_mb": self.budget / (1024 * 1024),
+        }
+
+    def __repr__(self):
+        s = self.stats()
+        return f"DequantCache(hits={s['hits']}, misses={s['misses']}, used={s['used_mb']:.0f}/{s['budget_mb']:.0f}MB)"
@@ -1,6 +1,7 @@
 # (c) City96 || Apache-2.0 (apache.org/licenses/LICENSE-2.0)
 import gguf
 import torch
+import threading
 from tqdm import tqdm
 
 
@@ -27,6 +28,28 @@ def dequantize_tensor(tensor, dtype=None, dequant_dtype=None):
         new = gguf.quants.dequantize(tensor.cpu().numpy(), qtype)
         return torch.from_numpy(new).to(tensor.device, dtype=dtype)
 
+def dequantize_tensor_rows(tensor, start, end, dtype=None, dequant_dtype=None):
+    """
+    Dequantize a slice of rows from a 2D quantized tensor
+    """
+    qtype = getattr(tensor, "tensor_type", None)
+    oshape = getattr(tensor, "tensor_shape", tensor.shape)
+    rows = tensor.data[start:end]
+
+    dequant_dtype = dtype if dequant_dtype == "target" else dequant_dtype
+    return dequantize(rows, qtype, (rows.shape[0], *oshape[1:]), dtype=dequant_dtype).to(dtype)
+
+def dequantize_tensor_index(tensor, index, dtype=None, dequant_dtype=None):
+    """
+    Dequantize the rows selected by `index` from a 2D quantized tensor
+    """
+    qtype = getattr(tensor, "tensor_type", None)
+    oshape = getattr(tensor, "tensor_shape", tensor.shape)
+    rows = tensor.data[index]
+
+    dequant_dtype = dtype if dequant_dtype == "target" else dequant_dtype
+    return dequantize(rows, qtype, (rows.shape[0], *oshape[1:]), dtype=dequant_dtype).to(dtype)
+
 def dequantize(data, qtype, oshape, dtype=None):
     """
     Dequantize tensor back to usable shape/dtype
@@ -43,19 +66,156 @@ def dequantize(data, qtype, oshape, dtype=None):
     blocks = dequantize_blocks(blocks, block_size, type_size, dtype)
     return blocks.reshape(oshape)
 
+class DequantWorkspace:
+    """
+    Per-device constant tables and reusable scratch buffers for the block kernels
+    """
+    # scratch memory a workspace keeps between kernel calls, raised to what the largest
+    # quantized layer needs as models load (see `reserve_scratch`), larger requests get a temporary
+    cache_bytes = 0
+
+    def __init__(self, device):
+        self.device = device
+        self.tables = {}
+        self.buffers = {}
+        self.table_allocs = 0
+        self.scratch_allocs = 0
+        self.scratch_reuses = 0
+        self.scratch_overflows = 0
+
+    def table(self, key, build):
+        table = self.tables.get(key)
+        if table is None:
+            table = build().to(self.device)
+            self.tables[key] = table
+            self.table_allocs += 1
+        return table
+
+    def shifts(self, *values, dtype=torch.uint8):
+        return self.table(("shifts", values, dtype), lambda: torch.tensor(values, dtype=dtype))
+
+    def scratch(self, name, shape, dtype):
+        # grows up to cache_bytes in total, the returned view is only valid
+        # until the next kernel call on this thread so it must never be returned
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        key = (name, dtype)
+        buffer = self.buffers.get(key)
+        if buffer is not None and buffer.numel() >= numel:
+            self.scratch_reuses += 1
+            return buffer[:numel].view(shape)
+
+        cached = sum(b.numel() * b.element_size() for k, b in self.buffers.items() if k != key)
+        if cached + numel * dtype.itemsize > self.cache_bytes:
+            self.scratch_overflows += 1
+            return torch.empty(shape, dtype=dtype, device=self.device)
+        self.buffers[key] = buffer = torch.empty(numel, dtype=dtype, device=self.device)
+        self.scratch_allocs += 1
+        return buffer[:numel].view(shape)
+
+    def stats(self):
+        return {
+            "device": str(self.device),
+            "tables": len(self.tables),
+            "table_allocs": self.table_allocs,
+            "scratch_allocs": self.scratch_allocs,
+            "scratch_reuses": self.scratch_reuses,
+            "scratch_overflows": self.scratch_overflows,
+            "scratch_mb": sum(b.numel() * b.element_size() for b in self.buffers.values()) / (1024 * 1024),
+        }
+
+# one workspace per device and thread, kernels may run on prefetch threads
+_workspace_local = threading.local()
+_workspaces = []
+_workspaces_lock = threading.Lock()
+
+def get_workspace(device):
+    by_device = getattr(_workspace_local, "by_device", None)
+    if by_device is None:
+        by_device = _workspace_local.by_device = {}
+    workspace = by_device.get(device)
+    if workspace is None:
+        workspace = by_device[device] = DequantWorkspace(device)
+        with _workspaces_lock:
+            _workspaces.append(workspace)
+    return workspace
+
+def workspace_stats():
+    with _workspaces_lock:
+        return [ws.stats() for ws in _workspaces]
+
+def workspace_reserve_bytes(threads=1):
+    """
+    Device memory the scratch buffers can hold at most, one workspace per dequantizing thread
+    """
+    return DequantWorkspace.cache_bytes * threads
+
+_scratch_per_block = {}
+
+def scratch_bytes(tensor, rows=None):
+    """
+    Scratch memory one dequantize call on tensor (or its first `rows` rows) takes in a workspace
+    """
+    qtype = getattr(tensor, "tensor_type", None)
+    if qtype not in dequantize_functions:
+        return 0
+    if qtype not in _scratch_per_block:
+        # measured on a few blocks in a workspace of its own, the buffers scale with the block count
+        block_size, type_size = gguf.GGML_QUANT_SIZES[qtype]
+        n_blocks = 16
+        by_device = getattr(_workspace_local, "by_device", None)
+        if by_device is None:
+            by_device = _workspace_local.by_device = {}
+        device = torch.device("cpu")
+        previous = by_device.get(device)
+        workspace = by_device[device] = DequantWorkspace(device)
+        workspace.cache_bytes = float("inf")
+        try:
+            dequantize(torch.zeros(n_blocks * type_size, dtype=torch.uint8), qtype, (n_blocks * block_size,), dtype=torch.float32)
+        finally:
+            if previous is None:
+                del by_device[device]
+            else:
+                by_device[device] = previous
+        _scratch_per_block[qtype] = workspace.stats()["scratch_mb"] * 1024 * 1024 / n_blocks
+
+    data = tensor.data if rows is None else tensor.data[:rows]
+    _, type_size = gguf.GGML_QUANT_SIZES[qtype]
+    return int(_scratch_per_block[qtype] * (data.numel() * data.element_size() // type_size))
+
+def reserve_scratch(nbytes):
+    # workspaces keep what the largest dequantize of any loaded model needs
+    DequantWorkspace.cache_bytes = max(DequantWorkspace.cache_bytes, nbytes)
+
+def clear_workspaces():
+    # drops the scratch buffers, constant tables are tiny and stay cached
+    with _workspaces_lock:
+        for ws in _workspaces:
+            ws.buffers.clear()
+
 def to_uint32(x):
     # no uint32 :(
-    x = x.view(torch.uint8).to(torch.int32)
-    return (x[:, 0] | x[:, 1] << 8 | x[:, 2] << 16 | x[:, 3] << 24).unsqueeze(1)
+    qh = get_workspace(x.device).scratch("qh32", x.shape, torch.uint8)
+    qh.copy_(x)
+    return qh.view(torch.int32)
 
 def split_block_dims(blocks, *args):
     n_max = blocks.shape[1]
     dims = list(args) + [n_max - sum(args)]
     return torch.split(blocks, dims, dim=1)
 
+def unpack_bits(ws, name, x, shape, shifts, mask):
+    """
+    Shift packed values into `shape` and mask them, in a scratch buffer
+    """
+    out = ws.scratch(name, shape, x.dtype)
+    torch.bitwise_right_shift(x, shifts, out=out)
+    return out.bitwise_and_(mask)
+
 # Full weights #
 def dequantize_blocks_BF16(blocks, block_size, type_size, dtype=None):
-    return (blocks.view(torch.int16).to(torch.int32) << 16).view(torch.float32)
+    return blocks.view(torch.int16).to(torch.int32).bitwise_left_shift_(16).view(torch.float32)
 
 # Legacy Quants #
 def dequantize_blocks_Q8_0(blocks, block_size, type_size, dtype=None):
@@ -64,58 +224,60 @@ def dequantize_blocks_Q8_0(blocks, block_size, type_size, dtype=None):
     x = x.view(torch.int8)
     return (d * x)
 
+def unpack_q5_high_bits(ws, qh, n_blocks):
+    qh = to_uint32(qh)
+    return unpack_bits(ws, "qh", qh, (n_blocks, 32), ws.shifts(*range(32), dtype=torch.int32).reshape((1, 32)), 1)
+
 def dequantize_blocks_Q5_1(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
+    ws = get_workspace(blocks.device)
 
     d, m, qh, qs = split_block_dims(blocks, 2, 2, 4)
     d = d.view(torch.float16).to(dtype)
     m = m.view(torch.float16).to(dtype)
-    qh = to_uint32(qh)
 
-    qh = qh.reshape((n_blocks, 1)) >> torch.arange(32, device=d.device, dtype=torch.int32).reshape(1, 32)
-    ql = qs.reshape((n_blocks, -1, 1, block_size // 2)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape(1, 1, 2, 1)
-    qh = (qh & 1).to(torch.uint8)
-    ql = (ql & 0x0F).reshape((n_blocks, -1))
+    qh = unpack_q5_high_bits(ws, qh, n_blocks)
+    ql = unpack_bits(ws, "ql", qs.reshape((n_blocks, 1, block_size // 2)), (n_blocks, 2, block_size // 2), ws.shifts(0, 4).reshape((1, 2, 1)), 0x0F)
 
-    qs = (ql | (qh << 4))
-    return (d * qs) + m
+    qs = qh.bitwise_left_shift_(4).bitwise_or_(ql.reshape((n_blocks, -1)))
+    return (d * qs).add_(m)
 
 def dequantize_blocks_Q5_0(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
+    ws = get_workspace(blocks.device)
 
     d, qh, qs = split_block_dims(blocks, 2, 4)
     d  = d.view(torch.float16).to(dtype)
-    qh = to_uint32(qh)
-
-    qh = qh.reshape(n_blocks, 1) >> torch.arange(32, device=d.device, dtype=torch.int32).reshape(1, 32)
-    ql = qs.reshape(n_blocks, -1, 1, block_size // 2) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape(1, 1, 2, 1)
 
-    qh = (qh & 1).to(torch.uint8)
-    ql = (ql & 0x0F).reshape(n_blocks, -1)
+    qh = unpack_q5_high_bits(ws, qh, n_blocks)
+    ql = unpack_bits(ws, "ql", qs.reshape((n_blocks, 1, block_size // 2)), (n_blocks, 2, block_size // 2), ws.shifts(0, 4).reshape((1, 2, 1)), 0x0F)
 
-    qs = (ql | (qh << 4)).to(torch.int8) - 16
+    qs = qh.bitwise_left_shift_(4).bitwise_or_(ql.reshape((n_blocks, -1)))
+    qs = qs.sub_(16)
     return (d * qs)
 
 def dequantize_blocks_Q4_1(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
+    ws = get_workspace(blocks.device)
 
     d, m, qs = split_block_dims(blocks, 2, 2)
     d = d.view(torch.float16).to(dtype)
     m = m.view(torch.float16).to(dtype)
 
-    qs = qs.reshape((n_blocks, -1, 1, block_size // 2)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape(1, 1, 2, 1)
-    qs = (qs & 0x0F).reshape(n_blocks, -1)
+    qs = unpack_bits(ws, "ql", qs.reshape((n_blocks, 1, block_size // 2)), (n_blocks, 2, block_size // 2), ws.shifts(0, 4).reshape((1, 2, 1)), 0x0F)
+    qs = qs.reshape((n_blocks, -1))
 
-    return (d * qs) + m
+    return (d * qs).add_(m)
 
 def dequantize_blocks_Q4_0(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
+    ws = get_workspace(blocks.device)
 
     d, qs = split_block_dims(blocks, 2)
     d  = d.view(torch.float16).to(dtype)
 
-    qs = qs.reshape((n_blocks, -1, 1, block_size // 2)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape((1, 1, 2, 1))
-    qs = (qs & 0x0F).reshape((n_blocks, -1)).to(torch.int8) - 8
+    qs = unpack_bits(ws, "ql", qs.reshape((n_blocks, 1, block_size // 2)), (n_blocks, 2, block_size // 2), ws.shifts(0, 4).reshape((1, 2, 1)), 0x0F)
+    qs = qs.reshape((n_blocks, -1)).view(torch.int8).sub_(8)
     return (d * qs)
 
 # K Quants #
@@ -124,18 +286,32 @@ K_SCALE_SIZE = 12
 
 def get_scale_min(scales):
     n_blocks = scales.shape[0]
+    ws = get_workspace(scales.device)
     scales = scales.view(torch.uint8)
     scales = scales.reshape((n_blocks, 3, 4))
 
-    d, m, m_d = torch.split(scales, scales.shape[-2] // 3, dim=-2)
+    d, m, m_d = scales[:, 0], scales[:, 1], scales[:, 2]
 
-    sc = torch.cat([d & 0x3F, (m_d & 0x0F) | ((d >> 2) & 0x30)], dim=-1)
-    min = torch.cat([m & 0x3F, (m_d >> 4) | ((m >> 2) & 0x30)], dim=-1)
+    # built in place, equivalent to
+    # sc = cat([d & 0x3F, (m_d & 0x0F) | ((d >> 2) & 0x30)])
+    # min = cat([m & 0x3F, (m_d >> 4) | ((m >> 2) & 0x30)])
+    sc = ws.scratch("sc", (n_blocks, 2, 4), torch.uint8)
+    min = ws.scratch("min", (n_blocks, 2, 4), torch.uint8)
+    tmp = ws.scratch("sc_tmp", (n_blocks, 4), torch.uint8)
+
+    torch.bitwise_and(d, 0x3F, out=sc[:, 0])
+    torch.bitwise_right_shift(d, 2, out=sc[:, 1]).bitwise_and_(0x30)
+    sc[:, 1].bitwise_or_(torch.bitwise_and(m_d, 0x0F, out=tmp))
+
+    torch.bitwise_and(m, 0x3F, out=min[:, 0])
+    torch.bitwise_right_shift(m, 2, out=min[:, 1]).bitwise_and_(0x30)
+    min[:, 1].bitwise_or_(torch.bitwise_right_shift(m_d, 4, out=tmp))
 
     return (sc.reshape((n_blocks, 8)), min.reshape((n_blocks, 8)))
 
 def dequantize_blocks_Q6_K(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
+    ws = get_workspace(blocks.device)
 
     ql, qh, scales, d, = split_block_dims(blocks, QK_K // 2, QK_K // 4, QK_K // 16)
 
@@ -143,17 +319,17 @@ def dequantize_blocks_Q6_K(blocks, block_size, type_size, dtype=None):
     d = d.view(torch.float16).to(dtype)
     d = (d * scales).reshape((n_blocks, QK_K // 16, 1))
 
-    ql = ql.reshape((n_blocks, -1, 1, 64)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape((1, 1, 2, 1))
-    ql = (ql & 0x0F).reshape((n_blocks, -1, 32))
-    qh = qh.reshape((n_blocks, -1, 1, 32)) >> torch.tensor([0, 2, 4, 6], device=d.device, dtype=torch.uint8).reshape((1, 1, 4, 1))
-    qh = (qh & 0x03).reshape((n_blocks, -1, 32))
-    q = (ql | (qh << 4)).to(torch.int8) - 32
+    ql = unpack_bits(ws, "ql", ql.reshape((n_blocks, -1, 1, 64)), (n_blocks, 2, 2, 64), ws.shifts(0, 4).reshape((1, 1, 2, 1)), 0x0F)
+    qh = unpack_bits(ws, "qh", qh.reshape((n_blocks, -1, 1, 32)), (n_blocks, 2, 4, 32), ws.shifts(0, 2, 4, 6).reshape((1, 1, 4, 1)), 0x03)
+    q = ql.reshape((n_blocks, -1, 32)).bitwise_or_(qh.reshape((n_blocks, -1, 32)).bitwise_left_shift_(4))
+    q = q.view(torch.int8).sub_(32)
     q = q.reshape((n_blocks, QK_K // 16, -1))
 
     return (d * q).reshape((n_blocks, QK_K))
 
 def dequantize_blocks_Q5_K(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
+    ws = get_workspace(blocks.device)
 
     d, dmin, scales, qh, qs = split_block_dims(blocks, 2, 2, K_SCALE_SIZE, QK_K // 8)
 
@@ -165,16 +341,15 @@ def dequantize_blocks_Q5_K(blocks, block_size, type_size, dtype=None):
     d = (d * sc).reshape((n_blocks, -1, 1))
     dm = (dmin * m).reshape((n_blocks, -1, 1))
 
-    ql = qs.reshape((n_blocks, -1, 1, 32)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape((1, 1, 2, 1))
-    qh = qh.reshape((n_blocks, -1, 1, 32)) >> torch.tensor([i for i in range(8)], device=d.device, dtype=torch.uint8).reshape((1, 1, 8, 1))
-    ql = (ql & 0x0F).reshape((n_blocks, -1, 32))
-    qh = (qh & 0x01).reshape((n_blocks, -1, 32))
-    q = (ql | (qh << 4))
+    ql = unpack_bits(ws, "ql", qs.reshape((n_blocks, -1, 1, 32)), (n_blocks, 4, 2, 32), ws.shifts(0, 4).reshape((1, 1, 2, 1)), 0x0F)
+    qh = unpack_bits(ws, "qh", qh.reshape((n_blocks, -1, 1, 32)), (n_blocks, 1, 8, 32), ws.shifts(*range(8)).reshape((1, 1, 8, 1)), 0x01)
+    q = ql.reshape((n_blocks, -1, 32)).bitwise_or_(qh.reshape((n_blocks, -1, 32)).bitwise_left_shift_(4))
 
-    return (d * q - dm).reshape((n_blocks, QK_K))
+    return (d * q).sub_(dm).reshape((n_blocks, QK_K))
 
 def dequantize_blocks_Q4_K(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
+    ws = get_workspace(blocks.device)
 
     d, dmin, scales, qs = split_block_dims(blocks, 2, 2, K_SCALE_SIZE)
     d = d.view(torch.float16).to(dtype)
@@ -185,54 +360,285 @@ def dequantize_blocks_Q4_K(blocks, block_size, type_size, dtype=None):
     d = (d * sc).reshape((n_blocks, -1, 1))
     dm = (dmin * m).reshape((n_blocks, -1, 1))
 
-    qs = qs.reshape((n_blocks, -1, 1, 32)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape((1, 1, 2, 1))
-    qs = (qs & 0x0F).reshape((n_blocks, -1, 32))
+    qs = unpack_bits(ws, "ql", qs.reshape((n_blocks, -1, 1, 32)), (n_blocks, 4, 2, 32), ws.shifts(0, 4).reshape((1, 1, 2, 1)), 0x0F)
+    qs = qs.reshape((n_blocks, -1, 32))
 
-    return (d * qs - dm).reshape((n_blocks, QK_K))
+    return (d * qs).sub_(dm).reshape((n_blocks, QK_K))
 
 def dequantize_blocks_Q3_K(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
+    ws = get_workspace(blocks.device)
 
     hmask, qs, scales, d = split_block_dims(blocks, QK_K // 8, QK_K // 4, 12)
     d = d.view(torch.float16).to(dtype)
 
     lscales, hscales = scales[:, :8], scales[:, 8:]
-    lscales = lscales.reshape((n_blocks, 1, 8)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape((1, 2, 1))
-    lscales = lscales.reshape((n_blocks, 16))
-    hscales = hscales.reshape((n_blocks, 1, 4)) >> torch.tensor([0, 2, 4, 6], device=d.device, dtype=torch.uint8).reshape((1, 4, 1))
-    hscales = hscales.reshape((n_blocks, 16))
-    scales = (lscales & 0x0F) | ((hscales & 0x03) << 4)
-    scales = (scales.to(torch.int8) - 32)
+    lscales = unpack_bits(ws, "lscales", lscales.reshape((n_blocks, 1, 8)), (n_blocks, 2, 8), ws.shifts(0, 4).reshape((1, 2, 1)), 0x0F)
+    hscales = unpack_bits(ws, "hscales", hscales.reshape((n_blocks, 1, 4)), (n_blocks, 4, 4), ws.shifts(0, 2, 4, 6).reshape((1, 4, 1)), 0x03)
+    scales = lscales.reshape((n_blocks, 16)).bitwise_or_(hscales.reshape((n_blocks, 16)).bitwise_left_shift_(4))
+    scales = scales.view(torch.int8).sub_(32)
 
     dl = (d * scales).reshape((n_blocks, 16, 1))
 
-    ql = qs.reshape((n_blocks, -1, 1, 32)) >> torch.tensor([0, 2, 4, 6], device=d.device, dtype=torch.uint8).reshape((1, 1, 4, 1))
-    qh = hmask.reshape(n_blocks, -1, 1, 32) >> torch.tensor([i for i in range(8)], device=d.device, dtype=torch.uint8).reshape((1, 1, 8, 1))
-    ql = ql.reshape((n_blocks, 16, QK_K // 16)) & 3
-    qh = (qh.reshape((n_blocks, 16, QK_K // 16)) & 1) ^ 1
-    q = (ql.to(torch.int8) - (qh << 2).to(torch.int8))
+    ql = unpack_bits(ws, "ql", qs.reshape((n_blocks, -1, 1, 32)), (n_blocks, 2, 4, 32), ws.shifts(0, 2, 4, 6).reshape((1, 1, 4, 1)), 3)
+    qh = unpack_bits(ws, "qh", hmask.reshape((n_blocks, -1, 1, 32)), (n_blocks, 1, 8, 32), ws.shifts(*range(8)).reshape((1, 1, 8, 1)), 1)
+    ql = ql.reshape((n_blocks, 16, QK_K // 16))
+    qh = qh.reshape((n_blocks, 16, QK_K // 16)).bitwise_xor_(1)
+    q = ql.view(torch.int8).sub_(qh.bitwise_left_shift_(2).view(torch.int8))
 
     return (dl * q).reshape((n_blocks, QK_K))
 
 def dequantize_blocks_Q2_K(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
+    ws = get_workspace(blocks.device)
 
     scales, qs, d, dmin = split_block_dims(blocks, QK_K // 16, QK_K // 4, 2)
     d = d.view(torch.float16).to(dtype)
     dmin = dmin.view(torch.float16).to(dtype)
 
     # (n_blocks, 16, 1)
-    dl = (d * (scales & 0xF)).reshape((n_blocks, QK_K // 16, 1))
-    ml = (dmin * (scales >> 4)).reshape((n_blocks, QK_K // 16, 1))
+    dl = (d * torch.bitwise_and(scales, 0xF, out=ws.scratch("sc", scales.shape, torch.uint8))).reshape((n_blocks, QK_K // 16, 1))
+    ml = (dmin * torch.bitwise_right_shift(scales, 4, out=ws.scratch("min", scales.shape, torch.uint8))).reshape((n_blocks, QK_K // 16, 1))
 
-    shift = torch.tensor([0, 2, 4, 6], device=d.device, dtype=torch.uint8).reshape((1, 1, 4, 1))
-
-    qs = (qs.reshape((n_blocks, -1, 1, 32)) >> shift) & 3
+    qs = unpack_bits(ws, "ql", qs.reshape((n_blocks, -1, 1, 32)), (n_blocks, 2, 4, 32), ws.shifts(0, 2, 4, 6).reshape((1, 1, 4, 1)), 3)
     qs = qs.reshape((n_blocks, QK_K // 16, 16))
-    qs = dl * qs - ml
+    qs = (dl * qs).sub_(ml)
 
     return qs.reshape((n_blocks, -1))
 
+# Ternary Quants #
+def dequantize_blocks_TQ2_0(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    qs, d = split_block_dims(blocks, QK_K // 4)
+    d = d.view(torch.float16).to(dtype)
+
+    qs = qs.reshape((n_blocks, -1, 1, 32)) >> get_workspace(d.device).shifts(0, 2, 4, 6).reshape((1, 1, 4, 1))
+    qs = (qs & 0x03).reshape((n_blocks, -1)).to(torch.int8) - 1
+    return (d * qs)
+
+def dequantize_blocks_TQ1_0(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    qs, qh, d = split_block_dims(blocks, (QK_K - 4 * QK_K // 64) // 5, QK_K // 64)
+    d = d.view(torch.float16).to(dtype)
+
+    # base-3 digits are recovered by multiplying with powers of 3 (mod 256)
+    pow3 = get_workspace(d.device).table("pow3", lambda: torch.tensor([1, 3, 9, 27, 81], dtype=torch.uint8))
+    qs0 = (qs[:, :32].reshape((n_blocks, -1, 1, 32)) * pow3.reshape((1, 1, 5, 1))).reshape((n_blocks, -1))
+    qs1 = (qs[:, 32:].reshape((n_blocks, -1, 1, 16)) * pow3.reshape((1, 1, 5, 1))).reshape((n_blocks, -1))
+    qh = (qh.reshape((n_blocks, -1, 1, 4)) * pow3[:4].reshape((1, 1, 4, 1))).reshape((n_blocks, -1))
+    qs = torch.cat([qs0, qs1, qh], dim=-1)
+    qs = ((qs.to(torch.int16) * 3) >> 8).to(torch.int8) - 1
+    return (d * qs)
+
+# 8-bit intermediate quant, only ever written by llama.cpp for activations
+def dequantize_blocks_Q8_K(blocks, block_size, type_size, dtype=None):
+    d, qs, bsums = split_block_dims(blocks, 4, QK_K)
+    d = d.view(torch.float32).to(dtype)
+    qs = qs.view(torch.int8)
+    return (d * qs)
+
+# I Quants #
+def get_iq_table(name, device):
+    """
+    Lookup tables shared with gguf-py, cached in the device workspace
+    """
+    def build():
+        if name == "ksigns":
+            return torch.frombuffer(bytearray(gguf.quants.IQ2_XXS.ksigns), dtype=torch.uint8)
+        elif name == "kvalues":
+            return torch.tensor(gguf.quants.IQ4_NL.kvalues, dtype=torch.int8)
+        quant = getattr(gguf.quants, name)
+        quant.init_grid()
+        return torch.from_numpy(quant.grid.copy()).reshape(quant.grid_shape)
+    return get_workspace(device).table(("iq", name), build)
+
+def view_as_int32(x):
+    # little-endian, same as the gguf layout
+    return x.contiguous().view(torch.int32)
+
+def view_as_uint16(x):
+    return x.contiguous().view(torch.int16).to(torch.int32) & 0xFFFF
+
+def unpack_sign_bits(signs):
+    bits = signs.unsqueeze(-1) >> get_workspace(signs.device).shifts(*range(8))
+    return 1 - 2 * (bits & 0x01).to(torch.int8)
+
+def dequantize_blocks_IQ4_NL(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    d, qs = split_block_dims(blocks, 2)
+    d = d.view(torch.float16).to(dtype)
+
+    qs = qs.reshape((n_blocks, -1, 1, block_size // 2)) >> get_workspace(d.device).shifts(0, 4).reshape((1, 1, 2, 1))
+    qs = (qs & 0x0F).reshape((n_blocks, -1))
+
+    kvalues = get_iq_table("kvalues", d.device)
+    return (d * kvalues[qs.long()])
+
+def dequantize_blocks_IQ4_XS(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    d, scales_h, scales_l, qs = split_block_dims(blocks, 2, 2, QK_K // 64)
+    d = d.view(torch.float16).to(dtype)
+    scales_h = view_as_uint16(scales_h)
+
+    scales_l = scales_l.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 4).reshape((1, 1, 2))
+    scales_h = scales_h.reshape((n_blocks, 1, -1)) >> get_workspace(d.device).shifts(*range(0, QK_K // 16, 2), dtype=torch.int32).reshape((1, -1, 1))
+    scales_l = scales_l.reshape((n_blocks, -1)) & 0x0F
+    scales_h = scales_h.reshape((n_blocks, -1)).to(torch.uint8) & 0x03
+
+    scales = (scales_l | (scales_h << 4)).to(torch.int8) - 32
+    dl = (d * scales).reshape((n_blocks, -1, 1))
+
+    qs = qs.reshape((n_blocks, -1, 1, 16)) >> get_workspace(d.device).shifts(0, 4).reshape((1, 1, 2, 1))
+    qs = (qs.reshape((n_blocks, -1, 32)) & 0x0F)
+
+    kvalues = get_iq_table("kvalues", d.device)
+    return (dl * kvalues[qs.long()]).reshape((n_blocks, -1))
+
+def dequantize_blocks_IQ3_S(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    d, qs, qh, signs, scales = split_block_dims(blocks, 2, QK_K // 4, QK_K // 32, QK_K // 8)
+    d = d.view(torch.float16).to(dtype)
+
+    scales = scales.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 4).reshape((1, 1, 2))
+    scales = (scales & 0x0F).reshape((n_blocks, -1))
+    db = (d * (1 + 2 * scales)).reshape((n_blocks, -1, 1, 1))
+
+    signs = unpack_sign_bits(signs).reshape((n_blocks, -1, 4, 8))
+
+    qh = qh.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(*range(8))
+    qh = (qh & 0x01).to(torch.int32).reshape((n_blocks, -1))
+    qs = qs.to(torch.int32) | (qh << 8)
+
+    grid = get_iq_table("IQ3_S", d.device)[qs.long()].reshape((n_blocks, -1, 4, 8))
+    return (db * grid * signs).reshape((n_blocks, -1))
+
+def dequantize_blocks_IQ3_XXS(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    d, qs, scales = split_block_dims(blocks, 2, QK_K // 4)
+    d = d.view(torch.float16).to(dtype)
+    scales = view_as_int32(scales)
+
+    db = d * (0.5 + ((scales >> 28) & 0x0F).to(d.dtype)) * 0.5
+    db = db.reshape((n_blocks, -1, 1, 1))
+
+    # sign indices are packed as 4x 7 bits per scale
+    signs = scales.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 7, 14, 21, dtype=torch.int32).reshape((1, 1, 4))
+    signs = get_iq_table("ksigns", d.device)[(signs & 0x7F).long()]
+    signs = unpack_sign_bits(signs).reshape((n_blocks, -1, 4, 8))
+
+    grid = get_iq_table("IQ3_XXS", d.device)[qs.long()].reshape((n_blocks, -1, 4, 8))
+    return (db * grid * signs).reshape((n_blocks, -1))
+
+def dequantize_blocks_IQ2_S(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    d, qs, signs, qh, scales = split_block_dims(blocks, 2, QK_K // 8, QK_K // 8, QK_K // 32)
+    d = d.view(torch.float16).to(dtype)
+
+    scales = scales.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 4).reshape((1, 1, 2))
+    scales = (scales & 0x0F).reshape((n_blocks, -1))
+    db = d * (0.5 + scales.to(d.dtype)) * 0.25
+    db = db.reshape((n_blocks, -1, 1, 1))
+
+    signs = unpack_sign_bits(signs).reshape((n_blocks, -1, 2, 8))
+
+    qh = qh.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 2, 4, 6).reshape((1, 1, 4))
+    qs = qs.to(torch.int32) | ((qh & 0x03).to(torch.int32) << 8).reshape((n_blocks, -1))
+
+    grid = get_iq_table("IQ2_S", d.device)[qs.long()].reshape((n_blocks, -1, 2, 8))
+    return (db * grid * signs).reshape((n_blocks, -1))
+
+def dequantize_blocks_IQ2_XS(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    d, qs, scales = split_block_dims(blocks, 2, 2 * QK_K // 8)
+    d = d.view(torch.float16).to(dtype)
+    qs = view_as_uint16(qs)
+
+    scales = scales.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 4).reshape((1, 1, 2))
+    scales = (scales & 0x0F).reshape((n_blocks, -1))
+    db = d * (0.5 + scales.to(d.dtype)) * 0.25
+    db = db.reshape((n_blocks, -1, 1, 1))
+
+    signs = get_iq_table("ksigns", d.device)[(qs >> 9).long()]
+    signs = unpack_sign_bits(signs).reshape((n_blocks, -1, 2, 8))
+
+    grid = get_iq_table("IQ2_XS", d.device)[(qs & 511).long()].reshape((n_blocks, -1, 2, 8))
+    return (db * grid * signs).reshape((n_blocks, -1))
+
+def dequantize_blocks_IQ2_XXS(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    d, qs = split_block_dims(blocks, 2)
+    d = d.view(torch.float16).to(dtype)
+    qs = view_as_int32(qs).reshape((n_blocks, -1, 2))
+
+    db = d * (0.5 + ((qs[..., 1] >> 28) & 0x0F).to(d.dtype)) * 0.25
+    db = db.reshape((n_blocks, -1, 1, 1))
+
+    # sign indices are packed as 4x 7 bits in the second word
+    signs = qs[..., 1].reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 7, 14, 21, dtype=torch.int32).reshape((1, 1, 4))
+    signs = get_iq_table("ksigns", d.device)[(signs & 0x7F).long()]
+    signs = unpack_sign_bits(signs).reshape((n_blocks, -1, 4, 8))
+
+    # grid indices are the 4 bytes of the first word
+    qs = qs[..., 0].contiguous().view(torch.uint8)
+    grid = get_iq_table("IQ2_XXS", d.device)[qs.long()].reshape((n_blocks, -1, 4, 8))
+    return (db * grid * signs).reshape((n_blocks, -1))
+
+IQ1_DELTA = 0.125
+
+def dequantize_blocks_IQ1_S(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    d, qs, qh = split_block_dims(blocks, 2, QK_K // 8)
+    d = d.view(torch.float16).to(dtype)
+    qh = view_as_uint16(qh)
+
+    dl = d * (2 * ((qh >> 12) & 7) + 1).to(d.dtype)
+    dl = dl.reshape((n_blocks, -1, 1, 1))
+    delta = torch.where((qh & 0x8000) == 0, IQ1_DELTA, -IQ1_DELTA).to(d.dtype)
+    delta = delta.reshape((n_blocks, -1, 1, 1))
+
+    qh = qh.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 3, 6, 9, dtype=torch.int32).reshape((1, 1, 4))
+    qs = qs.to(torch.int32) | ((qh & 7) << 8).reshape((n_blocks, -1))
+
+    grid = get_iq_table("IQ1_S", d.device)[qs.long()].reshape((n_blocks, -1, 4, 8))
+    return (dl * (grid + delta)).reshape((n_blocks, -1))
+
+def dequantize_blocks_IQ1_M(blocks, block_size, type_size, dtype=None):
+    n_blocks = blocks.shape[0]
+
+    qs, qh, scales = split_block_dims(blocks, QK_K // 8, QK_K // 16)
+    scales = view_as_uint16(scales)
+
+    # the f16 super-block scale is spread over the top nibbles of the 4 scale words
+    d = (scales & 0xF000) >> get_workspace(blocks.device).shifts(12, 8, 4, 0, dtype=torch.int32).reshape((1, 4))
+    d = d[:, 0] | d[:, 1] | d[:, 2] | d[:, 3]
+    d = torch.stack([d & 0xFF, d >> 8], dim=-1).to(torch.uint8)
+    d = d.view(torch.float16).to(dtype).reshape((n_blocks, 1))
+
+    scales = scales.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 3, 6, 9, dtype=torch.int32).reshape((1, 1, 4))
+    scales = (scales & 0x07).reshape((n_blocks, -1))
+    dl = d * (2 * scales + 1).to(d.dtype)
+    dl = dl.reshape((n_blocks, -1, 2, 1, 1))
+
+    qh = qh.reshape((n_blocks, -1, 1)) >> get_workspace(d.device).shifts(0, 4).reshape((1, 1, 2))
+    qh = qh.reshape((n_blocks, -1))
+    qs = qs.to(torch.int32) | ((qh & 0x07).to(torch.int32) << 8)
+
+    delta = torch.where((qh & 0x08) == 0, IQ1_DELTA, -IQ1_DELTA).to(d.dtype)
+    delta = delta.reshape((n_blocks, -1, 2, 2, 1))
+
+    grid = get_iq_table("IQ1_S", d.device)[qs.long()].reshape((n_blocks, -1, 2, 2, 8))
+    return (dl * (grid + delta)).reshape((n_blocks, -1))
+
 dequantize_functions = {
     gguf.GGMLQuantizationType.BF16: dequantize_blocks_BF16,
     gguf.GGMLQuantizationType.Q8_0: dequantize_blocks_Q8_0,
@@ -245,4 +651,16 @@ dequantize_functions = {
     gguf.GGMLQuantizationType.Q4_K: dequantize_blocks_Q4_K,
     gguf.GGMLQuantizationType.Q3_K: dequantize_blocks_Q3_K,
     gguf.GGMLQuantizationType.Q2_K: dequantize_blocks_Q2_K,
+    gguf.GGMLQuantizationType.Q8_K: dequantize_blocks_Q8_K,
+    gguf.GGMLQuantizationType.TQ2_0: dequantize_blocks_TQ2_0,
+    gguf.GGMLQuantizationType.TQ1_0: dequantize_blocks_TQ1_0,
+    gguf.GGMLQuantizationType.IQ4_NL: dequantize_blocks_IQ4_NL,
+    gguf.GGMLQuantizationType.IQ4_XS: dequantize_blocks_IQ4_XS,
+    gguf.GGMLQuantizationType.IQ3_S: dequantize_blocks_IQ3_S,
+    gguf.GGMLQuantizationType.IQ3_XXS: dequantize_blocks_IQ3_XXS,
+    gguf.GGMLQuantizationType.IQ2_S: dequantize_blocks_IQ2_S,
+    gguf.GGMLQuantizationType.IQ2_XS: dequantize_blocks_IQ2_XS,
+    gguf.GGMLQuantizationType.IQ2_XXS: dequantize_blocks_IQ2_XXS,
+    gguf.GGMLQuantizationType.IQ1_S: dequantize_blocks_IQ1_S,
+    gguf.GGMLQuantizationType.IQ1_M: dequantize_blocks_IQ1_M,
 }
\ No newline at end of file
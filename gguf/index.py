@@ -0,0 +1,131 @@
+# Sidecar index of the tensors in a GGUF file, skips re-parsing the header on later opens
+import os
+import json
+import glob
+import shutil
+import hashlib
+
+import gguf
+import numpy as np
+import torch
+
+INDEX_VERSION = 2
+
+def file_fingerprint(path, chunk_size=1024 * 1024):
+    """
+    Cheap identity for a (possibly huge) file: size, mtime and a hash of both ends
+    """
+    stat = os.stat(path)
+    h = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(path, "rb") as f:
+        h.update(f.read(chunk_size))
+        if stat.st_size > chunk_size:
+            f.seek(max(chunk_size, stat.st_size - chunk_size))
+            h.update(f.read(chunk_size))
+    return h.hexdigest()[:16]
+
+def remove_stale_caches(current, pattern):
+    """
+    Remove caches of older versions of the same file next to `current`, returns their paths
+    """
+    # `pattern` matches every fingerprint, same length names only differ in it
+    removed = []
+    for old in glob.glob(os.path.join(glob.escape(os.path.dirname(current)), pattern)):
+        if old != current and len(os.path.basename(old)) == len(os.path.basename(current)):
+            if os.path.isdir(old):
+                shutil.rmtree(old, ignore_errors=True)
+            else:
+                os.remove(old)
+            removed.append(old)
+    return removed
+
+def get_orig_shape(reader, tensor_name):
+    field_key = f"comfy.gguf.orig_shape.{tensor_name}"
+    field = reader.get_field(field_key)
+    if field is None:
+        return None
+    # Has original shape metadata, so we try to decode it.
+    if len(field.types) != 2 or field.types[0] != gguf.GGUFValueType.ARRAY or field.types[1] != gguf.GGUFValueType.INT32:
+        raise TypeError(f"Bad original shape metadata for {field_key}: Expected ARRAY of INT32, got {field.types}")
+    return torch.Size(tuple(int(field.parts[part_idx][0]) for part_idx in field.data))
+
+def get_orig_shapes(reader):
+    """
+    All original shapes stored in the metadata, split parts keep them in the first file
+    """
+    prefix = "comfy.gguf.orig_shape."
+    return {k[len(prefix):]: get_orig_shape(reader, k[len(prefix):]) for k in reader.fields if k.startswith(prefix)}
+
+def tensor_infos_from_reader(reader, orig_shapes):
+    """
+    Everything the state dict loaders need from each tensor, data is still an mmap view
+    """
+    infos = []
+    for tensor in reader.tensors:
+        infos.append({
+            "name": tensor.name,
+            "tensor_type": tensor.tensor_type,
+            "data": tensor.data,
+            "orig_shape": orig_shapes.get(tensor.name),
+            "shape": torch.Size(tuple(int(v) for v in reversed(tensor.shape))),
+            "offset": int(tensor.data_offset),
+        })
+    return infos
+
+def get_index_path(path, index_dir):
+    name = os.path.basename(path)
+    return os.path.join(index_dir, f"{name}.{file_fingerprint(path)}.index.json")
+
+def save_tensor_index(path, index_dir, arch, infos, orig_shapes):
+    index_path = get_index_path(path, index_dir)
+    tensors = [{
+        "name": info["name"],
+        "type": int(info["tensor_type"]),
+        "offset": info["offset"],
+        "dtype": info["data"].dtype.str,
+        "raw_shape": list(info["data"].shape),
+        "shape": list(info["shape"]),
+    } for info in infos]
+    orig_shapes = {k: list(v) for k, v in orig_shapes.items()}
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+        tmp = index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": INDEX_VERSION, "arch": arch, "orig_shapes": orig_shapes, "tensors": tensors}, f, separators=(",", ":"))
+        os.replace(tmp, index_path)
+    except OSError as e:
+        print(f"Failed to write GGUF index {index_path}: {e}")
+        return
+
+    remove_stale_caches(index_path, f"{glob.escape(os.path.basename(path))}.*.index.json")
+
+def load_tensor_index(path, index_dir):
+    """
+    Returns (arch, tensor infos, orig shapes) from the sidecar index, or None if there is no valid one
+    """
+    index_path = get_index_path(path, index_dir)
+    if not os.path.isfile(index_path):
+        return None
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != INDEX_VERSION:
+        return None
+
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    orig_shapes = {k: torch.Size(v) for k, v in index["orig_shapes"].items()}
+    infos = []
+    for t in index["tensors"]:
+        dtype = np.dtype(t["dtype"])
+        nbytes = int(np.prod(t["raw_shape"])) * dtype.itemsize
+        infos.append({
+            "name": t["name"],
+            "tensor_type": gguf.GGMLQuantizationType(t["type"]),
+            "data": data[t["offset"]:t["offset"] + nbytes].view(dtype).reshape(t["raw_shape"]),
+            "orig_shape": orig_shapes.get(t["name"]),
+            "shape": torch.Size(t["shape"]),
+            "offset": t["offset"],
+        })
+    return index["arch"], infos, orig_shapes
@@ -1,22 +1,20 @@
+import os
+import re
+import glob
 import torch
 import gguf
+import numpy as np
+import concurrent.futures
+from tqdm import tqdm
 
 from .ops import GGMLTensor
-from .dequant import is_quantized, dequantize_tensor
+from .dequant import is_quantized
+from .quant import quantize_tensor
+from .index import file_fingerprint, remove_stale_caches, get_orig_shapes, tensor_infos_from_reader, load_tensor_index, save_tensor_index
 
 IMG_ARCH_LIST = {"flux", "sd1", "sdxl", "sd3", "aura", "ltxv", "hyvid", "wan"}
 TXT_ARCH_LIST = {"t5", "t5encoder", "llama"}
 
-def get_orig_shape(reader, tensor_name):
-    field_key = f"comfy.gguf.orig_shape.{tensor_name}"
-    field = reader.get_field(field_key)
-    if field is None:
-        return None
-    # Has original shape metadata, so we try to decode it.
-    if len(field.types) != 2 or field.types[0] != gguf.GGUFValueType.ARRAY or field.types[1] != gguf.GGUFValueType.INT32:
-        raise TypeError(f"Bad original shape metadata for {field_key}: Expected ARRAY of INT32, got {field.types}")
-    return torch.Size(tuple(int(field.parts[part_idx][0]) for part_idx in field.data))
-
 def get_field(reader, field_name, field_type):
     field = reader.get_field(field_name)
     if field is None:
@@ -42,31 +40,86 @@ def get_list_field(reader, field_name, field_type):
     else:
         raise TypeError(f"Unknown field type {field_type}")
 
-def gguf_sd_loader(path, handle_prefix="model.diffusion_model.", return_arch=False):
+# llama.cpp gguf-split naming, i.e. model-00001-of-00003.gguf
+GGUF_SPLIT_PATTERN = re.compile(r"^(?P<prefix>.*)-(?P<no>\d{5})-of-(?P<count>\d{5})\.gguf$")
+
+def get_split_names(file_name):
     """
-    Read state dict as fake tensors
+    All part names of a split GGUF set given any of its parts, or just the name itself
     """
+    match = GGUF_SPLIT_PATTERN.match(file_name)
+    if match is None:
+        return [file_name]
+    count = int(match.group("count"))
+    return [f"{match.group('prefix')}-{i:05d}-of-{count:05d}.gguf" for i in range(1, count + 1)]
+
+def is_split_part(file_name):
+    # any part of a split set except the first
+    match = GGUF_SPLIT_PATTERN.match(os.path.basename(file_name))
+    return match is not None and int(match.group("no")) != 1
+
+def read_gguf_tensors(path, index_dir=None):
+    """
+    Architecture, tensor infos and original shapes of a single GGUF file
+    """
+    # the sidecar index has everything needed from the header, skip the reader if it's valid
+    index = load_tensor_index(path, index_dir) if index_dir is not None else None
+    if index is not None:
+        return index
     reader = gguf.GGUFReader(path)
+    arch_str = get_field(reader, "general.architecture", str)
+    orig_shapes = get_orig_shapes(reader)
+    infos = tensor_infos_from_reader(reader, orig_shapes)
+    if index_dir is not None:
+        save_tensor_index(path, index_dir, arch_str, infos, orig_shapes)
+    return arch_str, infos, orig_shapes
+
+def gguf_sd_loader(path, handle_prefix="model.diffusion_model.", return_arch=False, index_dir=None):
+    """
+    Read state dict as fake tensors
+    """
+    split_paths = [os.path.join(os.path.dirname(path), name) for name in get_split_names(os.path.basename(path))]
+    if len(split_paths) == 1:
+        arch_str, infos, _ = read_gguf_tensors(path, index_dir)
+    else:
+        missing = [p for p in split_paths if not os.path.isfile(p)]
+        if missing:
+            raise FileNotFoundError(f"Missing split GGUF parts: {', '.join(os.path.basename(p) for p in missing)}")
+        # parts are independent files, open them in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(split_paths), 8)) as pool:
+            parts = list(pool.map(lambda p: read_gguf_tensors(p, index_dir), split_paths))
+        print(f"Opened {len(parts)} split GGUF parts")
+
+        # metadata (arch, orig shapes) only lives in the first part
+        arch_str = parts[0][0]
+        orig_shapes = {}
+        for _, _, part_shapes in parts:
+            orig_shapes.update(part_shapes)
+        infos = []
+        for _, part_infos, _ in parts:
+            for info in part_infos:
+                if info["orig_shape"] is None:
+                    info["orig_shape"] = orig_shapes.get(info["name"])
+                infos.append(info)
 
     # filter and strip prefix
     has_prefix = False
     if handle_prefix is not None:
         prefix_len = len(handle_prefix)
-        tensor_names = set(tensor.name for tensor in reader.tensors)
+        tensor_names = set(info["name"] for info in infos)
         has_prefix = any(s.startswith(handle_prefix) for s in tensor_names)
 
     tensors = []
-    for tensor in reader.tensors:
-        sd_key = tensor_name = tensor.name
+    for info in infos:
+        sd_key = tensor_name = info["name"]
         if has_prefix:
             if not tensor_name.startswith(handle_prefix):
                 continue
             sd_key = tensor_name[prefix_len:]
-        tensors.append((sd_key, tensor))
+        tensors.append((sd_key, info))
 
     # detect and verify architecture
     compat = None
-    arch_str = get_field(reader, "general.architecture", str)
     if arch_str is None: # stable-diffusion.cpp
         # import here to avoid changes to convert.py breaking regular models
         from .tools.convert import detect_arch
@@ -85,13 +138,14 @@ def gguf_sd_loader(path, handle_prefix="model.diffusion_model.", return_arch=Fal
     # main loading loop
     state_dict = {}
     qtype_dict = {}
-    for sd_key, tensor in tensors:
-        tensor_name = tensor.name
-        torch_tensor = torch.from_numpy(tensor.data) # mmap
+    for sd_key, info in tensors:
+        tensor_name = info["name"]
+        tensor_type = info["tensor_type"]
+        torch_tensor = torch.from_numpy(info["data"]) # mmap
 
-        shape = get_orig_shape(reader, tensor_name)
+        shape = info["orig_shape"]
         if shape is None:
-            shape = torch.Size(tuple(int(v) for v in reversed(tensor.shape)))
+            shape = info["shape"]
             # Workaround for stable-diffusion.cpp SDXL detection.
             if compat == "sd.cpp" and arch_str == "sdxl":
                 if any([tensor_name.endswith(x) for x in (".proj_in.weight", ".proj_out.weight")]):
@@ -99,12 +153,17 @@ def gguf_sd_loader(path, handle_prefix="model.diffusion_model.", return_arch=Fal
                         shape = shape[:-1]
 
         # add to state dict
-        if tensor.tensor_type in {gguf.GGMLQuantizationType.F32, gguf.GGMLQuantizationType.F16}:
+        if tensor_type in {gguf.GGMLQuantizationType.F32, gguf.GGMLQuantizationType.F16}:
             torch_tensor = torch_tensor.view(*shape)
-        state_dict[sd_key] = GGMLTensor(torch_tensor, tensor_type=tensor.tensor_type, tensor_shape=shape)
+        state_dict[sd_key] = GGMLTensor(torch_tensor, tensor_type=tensor_type, tensor_shape=shape)
+
+        # file range backing the tensor, for readahead hints in streaming mode
+        mm = getattr(info["data"], "_mmap", None)
+        if mm is not None:
+            state_dict[sd_key].source_range = (mm, info["offset"], info["data"].nbytes)
 
         # keep track of loaded tensor types
-        tensor_type_str = getattr(tensor.tensor_type, "name", repr(tensor.tensor_type))
+        tensor_type_str = getattr(tensor_type, "name", repr(tensor_type))
         qtype_dict[tensor_type_str] = qtype_dict.get(tensor_type_str, 0) + 1
 
     # print loaded tensor type counts
@@ -120,6 +179,52 @@ def gguf_sd_loader(path, handle_prefix="model.diffusion_model.", return_arch=Fal
         return (state_dict, arch_str)
     return state_dict
 
+def quantize_sd_loader(path, qtype, key_filter=lambda k: ".blocks." in f".{k}", device=None):
+    """
+    Read a safetensors state dict, quantizing the 2D block weights as they are streamed in (on `device`)
+    """
+    from safetensors import safe_open
+    qtype = gguf.GGMLQuantizationType[qtype] if isinstance(qtype, str) else qtype
+    block_size, _ = gguf.GGML_QUANT_SIZES[qtype]
+    q8_block_size, _ = gguf.GGML_QUANT_SIZES[gguf.GGMLQuantizationType.Q8_0]
+
+    state_dict = {}
+    qtype_dict = {}
+    with safe_open(path, framework="pt", device="cpu") as f:
+        keys = list(f.keys())
+        if any(k.endswith("scaled_fp8") for k in keys):
+            raise ValueError("Can't quantize scaled fp8 checkpoints on load, use the fp16/bf16 weights instead")
+        for key in tqdm(keys, desc=f"Quantizing to {qtype.name}"):
+            tensor = f.get_tensor(key)
+            shape = tensor.shape
+            tensor_type = None
+            if tensor.dtype.is_floating_point and tensor.ndim == 2 and key.endswith(".weight") and key_filter(key):
+                # K quants need 256 wide rows, fall back to Q8_0 for anything else
+                if tensor.shape[1] % block_size == 0:
+                    tensor_type = qtype
+                elif tensor.shape[1] % q8_block_size == 0:
+                    tensor_type = gguf.GGMLQuantizationType.Q8_0
+            if tensor_type is not None:
+                tensor = quantize_tensor(tensor.to(device), tensor_type).cpu()
+            else:
+                tensor_type = {
+                    torch.float32: gguf.GGMLQuantizationType.F32,
+                    torch.float16: gguf.GGMLQuantizationType.F16,
+                }.get(tensor.dtype, None)
+            state_dict[key] = GGMLTensor(tensor, tensor_type=tensor_type, tensor_shape=shape)
+
+            tensor_type_str = getattr(tensor_type, "name", str(tensor.dtype))
+            qtype_dict[tensor_type_str] = qtype_dict.get(tensor_type_str, 0) + 1
+
+    print("quantized qtypes: " + ", ".join(f"{k} ({v})" for k, v in qtype_dict.items()))
+
+    # mark largest tensor for vram estimation
+    qsd = {k:v for k,v in state_dict.items() if is_quantized(v)}
+    if len(qsd) > 0:
+        max_key = max(qsd.keys(), key=lambda k: qsd[k].numel())
+        state_dict[max_key].is_largest_weight = True
+    return state_dict
+
 # for remapping llama.cpp -> original key names
 T5_SD_MAP = {
     "enc.": "encoder.",
@@ -174,7 +279,86 @@ def llama_permute(raw_sd, n_head, n_head_kv):
         sd[k] = v
     return sd
 
-def gguf_tokenizer_loader(path, temb_shape):
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def encode_varints(values):
+    """
+    Protobuf varints of a non-negative int array as (n, 10) byte rows and their lengths
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        lengths += values >= (1 << (7 * k))
+    shifts = np.arange(10, dtype=np.uint64) * np.uint64(7)
+    rows = ((values[:, None] >> shifts) & np.uint64(0x7F)).astype(np.uint8)
+    rows[np.arange(10) < lengths[:, None] - 1] |= 0x80
+    return rows, lengths
+
+def serialize_spm_pieces(tokens, scores, toktypes):
+    """
+    ModelProto.pieces as raw protobuf, same bytes as appending SentencePiece messages one by one
+    """
+    if len(tokens) == 0:
+        return b""
+    # SentencePiece: piece = 1 (string), score = 2 (float), type = 3 (enum)
+    token_lens = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+    len_rows, len_lens = encode_varints(token_lens)
+    type_rows, type_lens = encode_varints(toktypes)
+    msg_lens = 1 + len_lens + token_lens + 1 + 4 + 1 + type_lens
+    # ModelProto.pieces = 1 (repeated message)
+    msg_rows, msg_lens_lens = encode_varints(msg_lens)
+    piece_lens = 1 + msg_lens_lens + msg_lens
+
+    out = np.empty(int(piece_lens.sum()), dtype=np.uint8)
+    pos = np.cumsum(piece_lens) - piece_lens
+
+    # every field is written for all pieces at once, pos is the write position of each piece
+    def put(rows, lengths):
+        nonlocal pos
+        for k in range(rows.shape[1]):
+            mask = k < lengths
+            if not mask.any():
+                break
+            out[pos[mask] + k] = rows[mask, k]
+        pos = pos + lengths
+
+    def put_byte(value):
+        nonlocal pos
+        out[pos] = value
+        pos = pos + 1
+
+    put_byte(0x0a)
+    put(msg_rows, msg_lens_lens)
+    put_byte(0x0a)
+    put(len_rows, len_lens)
+    token_bytes = np.frombuffer(b"".join(tokens), dtype=np.uint8)
+    token_starts = np.cumsum(token_lens) - token_lens
+    out[np.repeat(pos - token_starts, token_lens) + np.arange(len(token_bytes))] = token_bytes
+    pos = pos + token_lens
+    put_byte(0x15)
+    put(np.asarray(scores, dtype="<f4").view(np.uint8).reshape(-1, 4), np.full(len(tokens), 4))
+    put_byte(0x18)
+    put(type_rows, type_lens)
+    return out.tobytes()
+
+def get_tokenizer_cache_path(path, cache_dir):
+    return os.path.join(cache_dir, f"{os.path.basename(path)}.{file_fingerprint(path)}.spiece.model")
+
+def gguf_tokenizer_loader(path, temb_shape, cache_dir=None):
+    # the rebuilt tokenizer only depends on the file, reuse it if it was cached before
+    cache_path = get_tokenizer_cache_path(path, cache_dir) if cache_dir is not None else None
+    if cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path, "rb") as f:
+            data = bytearray(f.read())
+        print(f"Using cached sentencepiece tokenizer {cache_path}")
+        return torch.frombuffer(data, dtype=torch.uint8)
+
     # convert gguf tokenizer to spiece
     print(f"Attempting to recreate sentencepiece tokenizer from GGUF file metadata...")
     try:
@@ -196,21 +380,12 @@ def gguf_tokenizer_loader(path, temb_shape):
     spm.normalizer_spec.add_dummy_prefix = get_field(reader, "tokenizer.ggml.add_space_prefix", bool)
     spm.normalizer_spec.remove_extra_whitespaces = get_field(reader, "tokenizer.ggml.remove_extra_whitespaces", bool)
 
-    tokens = get_list_field(reader, "tokenizer.ggml.tokens", str)
+    # raw utf-8 bytes, no need to decode just to encode them again
+    field = reader.get_field("tokenizer.ggml.tokens")
+    tokens = [field.parts[part_idx].tobytes() for part_idx in field.data]
     scores = get_list_field(reader, "tokenizer.ggml.scores", float)
     toktypes = get_list_field(reader, "tokenizer.ggml.token_type", int)
 
-    for idx, (token, score, toktype) in enumerate(zip(tokens, scores, toktypes)):
-        # # These aren't present in the original?
-        # if toktype == 5 and idx >= temb_shape[0]%1000):
-        #     continue
-
-        piece = spm.SentencePiece()
-        piece.piece = token
-        piece.score = score
-        piece.type = toktype
-        spm.pieces.append(piece)
-
     # unsure if any of these are correct
     spm.trainer_spec.byte_fallback = True
     spm.trainer_spec.vocab_size = len(tokens) # split off unused?
@@ -218,20 +393,31 @@ def gguf_tokenizer_loader(path, temb_shape):
     spm.trainer_spec.eos_id = get_field(reader, "tokenizer.ggml.eos_token_id", int)
     spm.trainer_spec.pad_id = get_field(reader, "tokenizer.ggml.padding_token_id", int)
 
-    print(f"Created tokenizer with vocab size of {len(spm.pieces)}")
+    # pieces are field 1, serializing them ahead of the rest gives the same bytes as spm.pieces.append
+    data = serialize_spm_pieces(tokens, scores, toktypes) + spm.SerializeToString()
+
+    print(f"Created tokenizer with vocab size of {len(tokens)}")
     del reader
-    return torch.ByteTensor(list(spm.SerializeToString()))
 
-def gguf_clip_loader(path):
-    sd, arch = gguf_sd_loader(path, return_arch=True)
+    if cache_path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(cache_path + ".tmp", cache_path)
+            remove_stale_caches(cache_path, f"{glob.escape(os.path.basename(path))}.*.spiece.model")
+        except OSError as e:
+            print(f"Failed to cache sentencepiece tokenizer {cache_path}: {e}")
+    return torch.frombuffer(bytearray(data), dtype=torch.uint8)
+
+def gguf_clip_loader(path, cache_dir=None):
+    sd, arch = gguf_sd_loader(path, return_arch=True, index_dir=cache_dir)
     if arch in {"t5", "t5encoder"}:
         temb_key = "token_embd.weight"
         if temb_key in sd and sd[temb_key].shape == (256384, 4096):
             # non-standard Comfy-Org tokenizer
-            sd["spiece_model"] = gguf_tokenizer_loader(path, sd[temb_key].shape)
-            # TODO: dequantizing token embed here is janky but otherwise we OOM due to tensor being massive.
-            print(f"Dequantizing {temb_key} to prevent runtime OOM.")
-            sd[temb_key] = dequantize_tensor(sd[temb_key], dtype=torch.float16)
+            sd["spiece_model"] = gguf_tokenizer_loader(path, sd[temb_key].shape, cache_dir=cache_dir)
+            # token embed stays quantized, GGMLOps.Embedding only dequantizes the rows it looks up
         sd = sd_map_replace(sd, T5_SD_MAP)
     elif arch in {"llama"}:
         temb_key = "token_embd.weight"
@@ -0,0 +1,155 @@
+# VRAM model of a GGUF diffusion model and the lowvram budget it leaves for a given amount of memory
+import math
+import torch
+from dataclasses import dataclass
+
+from .ops import GGMLLayer
+from .dequant import is_quantized, workspace_reserve_bytes
+
+@dataclass
+class LayerMemory:
+    name: str
+    weight_bytes: int   # storage as loaded (quantized blocks or plain tensor)
+    dequant_bytes: int  # temporaries while the weight is dequantized (and patched) for one forward
+    lora_bytes: int     # LoRA patch tensors of the layer
+
+@dataclass
+class MemoryPlan:
+    """
+    Byte budget for ComfyUI's lowvram loading, comfy still picks the modules (largest first)
+    """
+    budget: int
+    weight_bytes: int       # all weights (+ LoRA kept on device)
+    activation_bytes: int
+    temp_bytes: int         # largest dequant temporary, plus prefetched blocks, the weight cache and dequant workspaces
+    counted_temp_bytes: int # "temp.*" entries comfy itself counts as module memory (largest layer)
+
+    @property
+    def reserve_bytes(self):
+        return self.activation_bytes + self.temp_bytes
+
+    @property
+    def weight_budget(self):
+        return max(0, self.budget - self.reserve_bytes)
+
+    @property
+    def resident_bytes(self):
+        return min(self.weight_bytes, self.weight_budget)
+
+    @property
+    def full_load(self):
+        return self.weight_bytes <= self.weight_budget
+
+    @property
+    def lowvram_model_memory(self):
+        """
+        Value for ModelPatcher.load, 0 means load everything
+        """
+        if self.full_load:
+            return 0
+        # comfy counts the temp entries against the same budget, our reserve already covers them
+        return self.weight_budget + self.counted_temp_bytes + 1
+
+    def __repr__(self):
+        gb = 1024 ** 3
+        return (
+            f"MemoryPlan(budget={self.budget / gb:.2f} GB, weights={self.resident_bytes / gb:.2f}/{self.weight_bytes / gb:.2f} GB on device, "
+            f"activations={self.activation_bytes / gb:.2f} GB, temp={self.temp_bytes / gb:.2f} GB)"
+        )
+
+def tensor_bytes(t):
+    if t is None:
+        return 0
+    return t.data.numel() * t.data.element_size()
+
+def patch_bytes(patches):
+    # comfy patch tuples nest tensors in tuples/lists, LoRAAdapter keeps them in .weights
+    if isinstance(patches, torch.Tensor):
+        return tensor_bytes(patches)
+    if isinstance(patches, (list, tuple)):
+        return sum(patch_bytes(p) for p in patches)
+    if hasattr(patches, "weights"):
+        return patch_bytes(patches.weights)
+    return 0
+
+def layer_memory(name, module, dtype=torch.float16):
+    """
+    Memory use of a single GGMLLayer when it runs with inputs of `dtype`
+    """
+    weight = getattr(module, "weight", None)
+    weight_bytes = tensor_bytes(weight) + tensor_bytes(getattr(module, "bias", None))
+    lora_bytes = sum(patch_bytes(p[1]) for p in getattr(weight, "patches", []) or [])
+
+    dequant_bytes = 0
+    if weight is not None and is_quantized(weight) and not module.can_gather():
+        shape = getattr(weight, "tensor_shape", weight.shape)
+        if module.can_tile():
+            shape = (min(module.tile_rows, shape[0]), *shape[1:])
+        dequant_dtype = module.dequant_dtype if isinstance(module.dequant_dtype, torch.dtype) else dtype
+        dequant_bytes = math.prod(shape) * dequant_dtype.itemsize
+        if lora_bytes and module.get_lora_factors(weight) is None:
+            # merged LoRA: the patched copy is built in float32 next to the dequantized weight
+            dequant_bytes += math.prod(shape) * 4
+    return LayerMemory(name, weight_bytes, dequant_bytes, lora_bytes)
+
+def activation_bytes(diffusion_model, width, height, frames, batch=2, dtype=torch.float16):
+    """
+    Peak hidden state size of one Wan block for a width x height x frames video
+    """
+    # vae: 8x spatial, 4x temporal (+1), then (1, 2, 2) patches
+    tokens = ((frames - 1) // 4 + 1) * (height // 16) * (width // 16)
+    dim = getattr(diffusion_model, "dim", 5120)
+    ffn_dim = getattr(diffusion_model, "ffn_dim", 13824)
+    # residual stream + normed copy, next to either q/k/v/out or the ffn hidden state
+    return batch * tokens * dtype.itemsize * (2 * dim + max(4 * dim, ffn_dim))
+
+def counted_temp_bytes(module):
+    # what comfy's module_size adds for the layer on top of its weights
+    destination = {}
+    module.ggml_save_to_state_dict(destination, "", False)
+    return sum(tensor_bytes(t) for k, t in destination.items() if k.startswith("temp."))
+
+def plan_gguf_load(model, budget, width, height, frames, batch=2, dtype=torch.float16, patch_on_device=False, prefetch_blocks=0, cache_bytes=0):
+    """
+    Weight budget left after activations and dequant temporaries for the given inputs
+    """
+    diffusion_model = getattr(model, "diffusion_model", model)
+    blocks = list(getattr(diffusion_model, "blocks", []))
+    block_of = {}
+    for i, block in enumerate(blocks):
+        for m in block.modules():
+            block_of[id(m)] = i
+
+    weight_bytes = 0
+    counted_temp = 0
+    block_dequant = [0] * len(blocks)
+    largest_dequant = 0
+    for name, m in model.named_modules():
+        if isinstance(m, GGMLLayer):
+            mem = layer_memory(name, m, dtype)
+            size = mem.weight_bytes + (mem.lora_bytes if patch_on_device else 0)
+            temp = mem.dequant_bytes + (0 if patch_on_device else mem.lora_bytes)
+            largest_dequant = max(largest_dequant, temp)
+            if m.largest_layer and m.is_ggml_quantized():
+                counted_temp += counted_temp_bytes(m)
+        else:
+            # plain params directly on a module (i.e. block modulation)
+            size = sum(tensor_bytes(p) for p in m.parameters(recurse=False))
+            mem = LayerMemory(name, size, 0, 0)
+        weight_bytes += size
+        i = block_of.get(id(m))
+        if i is not None:
+            block_dequant[i] += mem.dequant_bytes
+
+    # the dequant workspaces of the main and the prefetch thread
+    temp_bytes = largest_dequant + cache_bytes + workspace_reserve_bytes(2 if prefetch_blocks > 0 else 1)
+    if prefetch_blocks > 0 and blocks:
+        temp_bytes += prefetch_blocks * max(block_dequant)
+
+    return MemoryPlan(
+        budget = budget,
+        weight_bytes = weight_bytes,
+        activation_bytes = activation_bytes(diffusion_model, width, height, frames, batch, dtype),
+        temp_bytes = temp_bytes,
+        counted_temp_bytes = counted_temp,
+    )
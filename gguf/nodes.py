@@ -1,4 +1,5 @@
 # (c) City96 || Apache-2.0 (apache.org/licenses/LICENSE-2.0)
+import os
 import torch
 import logging
 import collections
@@ -9,11 +10,19 @@ import comfy.model_patcher
 import comfy.model_management
 import folder_paths
 
-from .ops import GGMLOps, move_patch_to_device
-from .loader import gguf_sd_loader, gguf_clip_loader
-from .dequant import is_quantized, is_torch_compatible
+from .ops import GGMLOps, BlockPrefetcher, move_patch_to_device
+from .cache import DequantCache
+from .loader import gguf_sd_loader, gguf_clip_loader, quantize_sd_loader
+from .repack import gguf_repack_loader, REPACK_POLICIES
+from .stream import GGUFStreamer, prefetch_sources
+from .dequant import is_quantized, is_torch_compatible, clear_workspaces
+from .memory import plan_gguf_load
+from ..model_patcher.offload import HostArena
 
-def load_gguf(unet_path, dequant_dtype=None, patch_dtype=None, patch_on_device=None):
+def get_cache_dir():
+    return os.path.join(folder_paths.models_dir, "gguf_cache")
+
+def load_gguf(unet_path, dequant_dtype=None, patch_dtype=None, patch_on_device=None, dequant_cache_mb=0, tile_rows=0, prefetch_blocks=0, repack_cache=None, quantize=None, lora_mode=None, stream_blocks=0, host_arena=False, memory_planner=False):
     ops = GGMLOps()
 
     if dequant_dtype in ("default", None):
@@ -30,8 +39,28 @@ def load_gguf(unet_path, dequant_dtype=None, patch_dtype=None, patch_on_device=N
     else:
         ops.Linear.patch_dtype = getattr(torch, patch_dtype)
 
+    # keep dequantized weights around between steps if there is memory to spare
+    weight_cache = DequantCache(dequant_cache_mb) if dequant_cache_mb > 0 else None
+    ops.Linear.weight_cache = weight_cache
+
+    # dequantize large linear weights in row tiles to bound temporary memory
+    ops.Linear.tile_rows = tile_rows if tile_rows > 0 else None
+
+    # keep LoRA factors separate instead of merging them into every dequantized weight
+    ops.Linear.lora_mode = "side" if lora_mode == "side" else None
+
+    # the prefetch thread keeps a second dequant workspace
+    ops.Linear.workspace_threads = 2 if prefetch_blocks > 0 else 1
+
     # init model
-    sd = gguf_sd_loader(unet_path)
+    if quantize is not None:
+        # safetensors checkpoint, quantized while it is read
+        # the K quant scale search is much faster on the GPU
+        sd = quantize_sd_loader(unet_path, quantize, device=comfy.model_management.get_torch_device())
+    elif repack_cache in REPACK_POLICIES:
+        sd = gguf_repack_loader(unet_path, repack_cache, get_cache_dir(), gguf_sd_loader)
+    else:
+        sd = gguf_sd_loader(unet_path, index_dir=get_cache_dir())
     model = comfy.sd.load_diffusion_model_state_dict(
         sd, model_options={"custom_operations": ops}
     )
@@ -40,10 +69,32 @@ def load_gguf(unet_path, dequant_dtype=None, patch_dtype=None, patch_on_device=N
         raise RuntimeError("ERROR: Could not detect model type of: {}".format(unet_path))
     model = GGUFModelPatcher.clone(model)
     model.patch_on_device = patch_on_device
+    model.weight_cache = weight_cache
+    model.prefetch_blocks = prefetch_blocks
+    model.stream_blocks = stream_blocks
+    model.host_arena = host_arena
+    model.memory_planner = memory_planner
     return model
 
+def load_gguf_clip(clip_path, clip_type, model_options={}):
+    # token_embd stays quantized, GGMLOps.Embedding only dequantizes the rows it looks up
+    sd = gguf_clip_loader(clip_path, cache_dir=get_cache_dir())
+    clip = comfy.sd.load_text_encoder_state_dicts(
+        state_dicts=[sd], clip_type=clip_type,
+        model_options={**model_options, "custom_operations": GGMLOps()},
+        embedding_directory=folder_paths.get_folder_paths("embeddings"),
+    )
+    clip.patcher = GGUFModelPatcher.clone(clip.patcher)
+    return clip
+
 class GGUFModelPatcher(comfy.model_patcher.ModelPatcher):
     patch_on_device = False
+    weight_cache = None
+    prefetch_blocks = 0
+    stream_blocks = 0
+    host_arena = False
+    memory_planner = False
+    plan_input = None
 
     def patch_weight_to_device(self, key, device_to=None, inplace_update=False):
         if key not in self.patches:
@@ -89,16 +140,55 @@ class GGUFModelPatcher(comfy.model_patcher.ModelPatcher):
                 patches = getattr(p, "patches", [])
                 if len(patches) > 0:
                     p.patches = []
+        if self.weight_cache is not None:
+            if self.weight_cache.hits + self.weight_cache.misses > 0:
+                print(f"Releasing {self.weight_cache}")
+            self.weight_cache.clear()
+        prefetcher = getattr(self.model, "gguf_prefetcher", None)
+        if prefetcher is not None:
+            prefetcher.clear()
+        if unpatch_weights:
+            clear_workspaces()
         # TODO: Find another way to not unload after patches
         return super().unpatch_model(device_to=device_to, unpatch_weights=unpatch_weights)
 
+    def memory_required(self, *args, **kwargs):
+        # comfy frees this much for inference before loading, the dequant cache is VRAM next to it
+        required = super().memory_required(*args, **kwargs)
+        if self.weight_cache is not None:
+            required += self.weight_cache.budget
+        return required
+
+    def plan_memory(self):
+        """
+        Lowvram plan for the current inputs (see `plan_input`) and free memory
+        """
+        # same reserves comfy's load_models_gpu keeps free for activations
+        budget = comfy.model_management.get_free_memory(self.load_device) + self.model.model_loaded_weight_memory
+        budget -= comfy.model_management.minimum_inference_memory() + comfy.model_management.extra_reserved_memory()
+        dtype = self.model.manual_cast_dtype or self.model.get_dtype()
+        cache_bytes = self.weight_cache.budget if self.weight_cache is not None else 0
+        return plan_gguf_load(
+            self.model, budget, dtype=dtype, patch_on_device=self.patch_on_device,
+            prefetch_blocks=self.prefetch_blocks, cache_bytes=cache_bytes, **self.plan_input,
+        )
+
     mmap_released = False
     def load(self, *args, force_patch_weights=False, **kwargs):
+        device_to = args[0] if args else kwargs.get("device_to")
+        if self.memory_planner and self.plan_input is not None and device_to == self.load_device and self.load_device.type != "cpu":
+            # replace comfy's estimate (fake state dict + one temp weight) with a budget from the per-layer model
+            plan = self.plan_memory()
+            print(f"Using {plan}")
+            kwargs["lowvram_model_memory"] = plan.lowvram_model_memory
+            kwargs["full_load"] = plan.full_load
+
         # always call `patch_weight_to_device` even for lowvram
         super().load(*args, force_patch_weights=True, **kwargs)
 
         # make sure nothing stays linked to mmap after first load
-        if not self.mmap_released:
+        # (unless streaming, where offloaded weights are read from the file as blocks run)
+        if not self.mmap_released and self.stream_blocks == 0:
             linked = []
             if kwargs.get("lowvram_model_memory", 0) > 0:
                 for n, m in self.model.named_modules():
@@ -114,11 +204,28 @@ class GGUFModelPatcher(comfy.model_patcher.ModelPatcher):
                             continue
             if linked:
                 print(f"Attempting to release mmap ({len(linked)})")
-                for n, m in linked:
-                    # TODO: possible to OOM, find better way to detach
-                    m.to(self.load_device).to(self.offload_device)
+                prefetch_sources(p for _, m in linked for p in m.parameters(recurse=False))
+                if self.host_arena and self.offload_device.type == "cpu":
+                    # copy straight from the file into one host buffer, no round trip through the GPU
+                    tensors = [p for _, m in linked for p in m.parameters(recurse=False) if p.device == self.offload_device]
+                    self.model.gguf_host_arena = HostArena(tensors)
+                    print(f"Released mmap into {self.model.gguf_host_arena}")
+                else:
+                    for n, m in linked:
+                        # TODO: possible to OOM, find better way to detach
+                        m.to(self.load_device).to(self.offload_device)
             self.mmap_released = True
 
+        # dequantize the next transformer block(s) while the current one runs
+        blocks = getattr(getattr(self.model, "diffusion_model", None), "blocks", None)
+        if self.prefetch_blocks > 0 and blocks is not None and getattr(self.model, "gguf_prefetcher", None) is None:
+            self.model.gguf_prefetcher = BlockPrefetcher(blocks, self.prefetch_blocks).install(blocks)
+            print(f"Using {self.model.gguf_prefetcher}")
+
+        if self.stream_blocks > 0 and blocks is not None and getattr(self.model, "gguf_streamer", None) is None:
+            self.model.gguf_streamer = GGUFStreamer(blocks, self.stream_blocks).install()
+            print(f"Using {self.model.gguf_streamer}")
+
     def clone(self, *args, **kwargs):
         src_cls = self.__class__
         self.__class__ = GGUFModelPatcher
@@ -127,4 +234,10 @@ class GGUFModelPatcher(comfy.model_patcher.ModelPatcher):
         self.__class__ = src_cls
         # GGUF specific clone values below
         n.patch_on_device = getattr(self, "patch_on_device", False)
+        n.weight_cache = getattr(self, "weight_cache", None)
+        n.prefetch_blocks = getattr(self, "prefetch_blocks", 0)
+        n.stream_blocks = getattr(self, "stream_blocks", 0)
+        n.host_arena = getattr(self, "host_arena", False)
+        n.memory_planner = getattr(self, "memory_planner", False)
+        n.plan_input = getattr(self, "plan_input", None)
         return n
\ No newline at end of file
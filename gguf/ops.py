@@ -1,10 +1,11 @@
 # (c) City96 || Apache-2.0 (apache.org/licenses/LICENSE-2.0)
 import gguf
 import torch
+import concurrent.futures
 
 import comfy.ops
 import comfy.model_management
-from .dequant import dequantize_tensor, is_quantized
+from .dequant import dequantize_tensor, dequantize_tensor_rows, dequantize_tensor_index, dequantize_functions, is_quantized, workspace_reserve_bytes, scratch_bytes, reserve_scratch
 
 # to avoid breaking really old pytorch versions
 if hasattr(torch, "compiler") and hasattr(torch.compiler, "disable"):
@@ -71,7 +72,14 @@ class GGMLLayer(torch.nn.Module):
     comfy_cast_weights = True
     dequant_dtype = None
     patch_dtype = None
+    weight_cache = None
+    tile_rows = None
+    lora_mode = None
+    lora_factors = None
+    prefetched = None
+    prefetch_requests = None
     largest_layer = False
+    workspace_threads = 1 # threads that dequantize (and keep a workspace) on the device
     torch_compatible_tensor_types = {None, gguf.GGMLQuantizationType.F32, gguf.GGMLQuantizationType.F16}
 
     def is_ggml_quantized(self, *, weight=None, bias=None):
@@ -108,6 +116,10 @@ class GGMLLayer(torch.nn.Module):
         if getattr(self.weight, "is_largest_weight", False):
             self.largest_layer = True
 
+        # the dequant workspaces keep scratch for the layer that needs the most, so no layer allocates per call
+        if is_quantized(self.weight) and not self.can_gather():
+            reserve_scratch(scratch_bytes(self.weight, self.tile_rows if self.can_tile() else None))
+
     def _save_to_state_dict(self, *args, **kwargs):
         if self.is_ggml_quantized():
             return self.ggml_save_to_state_dict(*args, **kwargs)
@@ -122,11 +134,17 @@ class GGMLLayer(torch.nn.Module):
             destination[prefix + "bias"] = bias
 
         # Take into account space required for dequantizing the largest tensor
-        if self.largest_layer:
+        if self.largest_layer and not self.can_gather():
             shape = getattr(self.weight, "tensor_shape", self.weight.shape)
+            if self.can_tile():
+                shape = (min(self.tile_rows, shape[0]), *shape[1:])
             dtype = self.dequant_dtype or torch.float16
             temp = torch.empty(*shape, device=torch.device("meta"), dtype=dtype)
             destination[prefix + "temp.weight"] = temp
+        if self.largest_layer:
+            # scratch buffers kept by the dequant workspaces
+            workspace = torch.empty(workspace_reserve_bytes(self.workspace_threads), device=torch.device("meta"), dtype=torch.uint8)
+            destination[prefix + "temp.workspace"] = workspace
 
         return
         # This would return the dequantized state dict
@@ -134,6 +152,96 @@ class GGMLLayer(torch.nn.Module):
         if bias is not None:
             destination[prefix + "bias"] = self.get_weight(self.bias)
 
+    def can_tile(self):
+        # only plain 2D weights can be split by rows, patches need the full weight
+        if not self.tile_rows or not isinstance(self, torch.nn.Linear):
+            return False
+        weight = self.weight
+        shape = getattr(weight, "tensor_shape", weight.shape)
+        return (
+            getattr(weight, "tensor_type", None) in dequantize_functions
+            and len(shape) == 2 and weight.data.ndim == 2 and weight.data.shape[0] == shape[0]
+            and shape[0] > self.tile_rows
+            and (not getattr(weight, "patches", []) or self.get_lora_factors(weight) is not None)
+            and not self.fits_weight_cache()
+        )
+
+    def fits_weight_cache(self):
+        # a weight the dequant cache can hold is kept whole there instead of being tiled (assumes 2 byte weights)
+        cache = self.weight_cache
+        return cache is not None and torch.Size(getattr(self.weight, "tensor_shape", self.weight.shape)).numel() * 2 <= cache.budget
+
+    def can_gather(self):
+        # embeddings only need the rows for the ids in the input
+        if not isinstance(self, torch.nn.Embedding) or self.max_norm is not None:
+            return False
+        weight = self.weight
+        shape = getattr(weight, "tensor_shape", weight.shape)
+        return (
+            getattr(weight, "tensor_type", None) in dequantize_functions
+            and len(shape) == 2 and weight.data.ndim == 2 and weight.data.shape[0] == shape[0]
+            and not getattr(weight, "patches", [])
+        )
+
+    def get_lora_factors(self, tensor):
+        """
+        Split plain LoRA patches into (down, up, scale) factors for the side path
+        """
+        if self.lora_mode != "side" or not isinstance(self, torch.nn.Linear):
+            return None
+        patches = getattr(tensor, "patches", [])
+        if len(patches) != 1:
+            return None
+        patch_list = patches[0][1]
+        if self.lora_factors is not None and self.lora_factors[0] is patch_list:
+            return self.lora_factors[1]
+
+        factors = []
+        for p in patch_list:
+            strength, v = p[0], p[1]
+            strength_model = p[2] if len(p) > 2 else 1.0
+            offset = p[3] if len(p) > 3 else None
+            function = p[4] if len(p) > 4 else None
+            if strength_model != 1.0 or offset is not None or function is not None:
+                return None
+            if isinstance(v, tuple) and len(v) == 2 and v[0] == "lora":
+                weights = v[1]
+            elif type(v).__name__ == "LoRAAdapter":
+                weights = v.weights
+            else:
+                return None
+            # mid (LoCon), DoRA and reshaped LoRAs still need the full merge
+            up, down, alpha, mid, dora_scale = weights[:5]
+            reshape = weights[5] if len(weights) > 5 else None
+            if mid is not None or dora_scale is not None or reshape is not None or up.ndim != 2 or down.ndim != 2:
+                return None
+            if strength == 0:
+                continue
+            scale = strength * (alpha / down.shape[0] if alpha is not None else 1.0)
+            factors.append((down, up, scale))
+
+        # keyed on the patch list so a new set of LoRAs is picked up
+        self.lora_factors = (patch_list, factors, {})
+        return factors
+
+    def forward_lora(self, input, out):
+        factors = self.get_lora_factors(self.weight)
+        if factors is None:
+            # LoRAs were unloaded (or can't be split), drop the cast factors
+            self.lora_factors = None
+            return out
+        # low rank factors are cast once per device/dtype
+        cast = self.lora_factors[2]
+        key = (input.device, input.dtype)
+        if key not in cast:
+            cast.clear()
+            cast[key] = [(down.to(input.device, input.dtype), up.to(input.device, input.dtype), scale) for down, up, scale in factors]
+        if not cast[key]:
+            return out
+        for down, up, scale in cast[key]:
+            out = out + scale * torch.nn.functional.linear(torch.nn.functional.linear(input, down), up)
+        return out
+
     def get_weight(self, tensor, dtype):
         if tensor is None:
             return
@@ -141,8 +249,9 @@ class GGMLLayer(torch.nn.Module):
         # consolidate and load patches to GPU in async
         patch_list = []
         device = tensor.device
-        for function, patches, key in getattr(tensor, "patches", []):
-            patch_list += move_patch_to_device(patches, device)
+        if self.get_lora_factors(tensor) is None:
+            for function, patches, key in getattr(tensor, "patches", []):
+                patch_list += move_patch_to_device(patches, device)
 
         # dequantize tensor while patches load
         weight = dequantize_tensor(tensor, dtype, self.dequant_dtype)
@@ -174,13 +283,68 @@ class GGMLLayer(torch.nn.Module):
         bias = None
         non_blocking = comfy.model_management.device_supports_non_blocking(device)
         if s.bias is not None:
-            bias = s.get_weight(s.bias.to(device), dtype)
-            bias = comfy.ops.cast_to(bias, bias_dtype, device, non_blocking=non_blocking, copy=False)
+            bias = s.get_cast_weight("bias", dtype, bias_dtype, device, non_blocking)
 
-        weight = s.get_weight(s.weight.to(device), dtype)
-        weight = comfy.ops.cast_to(weight, dtype, device, non_blocking=non_blocking, copy=False)
+        weight = s.get_cast_weight("weight", dtype, dtype, device, non_blocking)
         return weight, bias
 
+    def get_cast_weight(self, name, dtype, cast_dtype, device, non_blocking):
+        tensor = getattr(self, name)
+        if self.prefetched is not None:
+            weight = self.take_prefetched(name, tensor, dtype, cast_dtype, device)
+            if weight is not None:
+                if self.weight_cache is not None:
+                    weight = self.weight_cache.put((id(self), name, cast_dtype, device), tensor, weight)
+                return weight
+
+        cache = self.weight_cache
+        if cache is not None:
+            key = (id(self), name, cast_dtype, device)
+            weight = cache.get(key, tensor)
+            if weight is not None:
+                return weight
+
+        weight = self.get_weight(tensor.to(device), dtype)
+        weight = comfy.ops.cast_to(weight, cast_dtype, device, non_blocking=non_blocking, copy=False)
+        if cache is not None:
+            weight = cache.put(key, tensor, weight)
+        return weight
+
+    def take_prefetched(self, name, tensor, dtype, cast_dtype, device):
+        # remember what the layer asked for so the next prefetch matches it
+        self.prefetch_requests[name] = (dtype, cast_dtype, device)
+        entry = self.prefetched.pop((name, cast_dtype, device), None)
+        # stale if the param or its patch list was swapped out after the prefetch
+        if entry is None or entry[0] is not tensor or entry[1] is not getattr(tensor, "patches", None):
+            return None
+        weight, event = entry[2], entry[3]
+        if event is not None:
+            stream = torch.cuda.current_stream(device)
+            stream.wait_event(event)
+            weight.record_stream(stream)
+        return weight
+
+    def prefetch(self, stream=None):
+        # runs on the prefetch thread, dequantizes for the last seen dtype/device
+        for name, (dtype, cast_dtype, device) in list(self.prefetch_requests.items()):
+            tensor = getattr(self, name)
+            key = (name, cast_dtype, device)
+            if tensor is None or key in self.prefetched:
+                continue
+            if self.weight_cache is not None and (id(self), *key) in self.weight_cache.entries:
+                continue
+            event = None
+            if stream is not None:
+                with torch.cuda.stream(stream):
+                    weight = self.get_weight(tensor.to(device, non_blocking=True), dtype)
+                    weight = comfy.ops.cast_to(weight, cast_dtype, device, non_blocking=True, copy=False)
+                    event = torch.cuda.Event()
+                    event.record(stream)
+            else:
+                weight = self.get_weight(tensor.to(device), dtype)
+                weight = comfy.ops.cast_to(weight, cast_dtype, device, copy=False)
+            self.prefetched[key] = (tensor, getattr(tensor, "patches", None), weight, event)
+
     def forward_comfy_cast_weights(self, input, *args, **kwargs):
         if self.is_ggml_quantized():
             out = self.forward_ggml_cast_weights(input, *args, **kwargs)
@@ -211,8 +375,37 @@ class GGMLOps(comfy.ops.manual_cast):
             self.bias = None
 
         def forward_ggml_cast_weights(self, input):
-            weight, bias = self.cast_bias_weight(input)
-            return torch.nn.functional.linear(input, weight, bias)
+            if self.can_tile():
+                out = self.forward_ggml_tiled(input)
+            else:
+                weight, bias = self.cast_bias_weight(input)
+                out = torch.nn.functional.linear(input, weight, bias)
+            if self.lora_mode == "side":
+                out = self.forward_lora(input, out)
+            return out
+
+        @torch_compiler_disable()
+        def forward_ggml_tiled(self, input):
+            # dequantize `tile_rows` output features at a time so the temporary
+            # weight is bounded by the tile instead of the full layer
+            dtype, device = input.dtype, input.device
+            non_blocking = comfy.model_management.device_supports_non_blocking(device)
+
+            bias = None
+            if self.bias is not None:
+                bias = self.get_weight(self.bias.to(device), dtype)
+                bias = comfy.ops.cast_to(bias, dtype, device, non_blocking=non_blocking, copy=False)
+
+            weight = self.weight.to(device)
+            out = torch.empty((*input.shape[:-1], self.out_features), dtype=dtype, device=device)
+            for start in range(0, self.out_features, self.tile_rows):
+                end = min(start + self.tile_rows, self.out_features)
+                tile = dequantize_tensor_rows(weight, start, end, dtype, self.dequant_dtype)
+                tile = comfy.ops.cast_to(tile, dtype, device, non_blocking=non_blocking, copy=False)
+                tile_bias = bias[start:end] if bias is not None else None
+                out[..., start:end] = torch.nn.functional.linear(input, tile, tile_bias)
+                del tile
+            return out
 
     class Conv2d(GGMLLayer, comfy.ops.manual_cast.Conv2d):
         def forward_ggml_cast_weights(self, input):
@@ -221,6 +414,8 @@ class GGMLOps(comfy.ops.manual_cast):
 
     class Embedding(GGMLLayer, comfy.ops.manual_cast.Embedding):
         def forward_ggml_cast_weights(self, input, out_dtype=None):
+            if self.can_gather():
+                return self.forward_ggml_gather(input, out_dtype)
             output_dtype = out_dtype
             if self.weight.dtype == torch.float16 or self.weight.dtype == torch.bfloat16:
                 out_dtype = None
@@ -229,6 +424,14 @@ class GGMLOps(comfy.ops.manual_cast):
                 input, weight, self.padding_idx, self.max_norm, self.norm_type, self.scale_grad_by_freq, self.sparse
             ).to(dtype=output_dtype)
 
+        @torch_compiler_disable()
+        def forward_ggml_gather(self, input, out_dtype=None):
+            # dequantize only the (unique) rows that are looked up, not the whole table
+            dtype = out_dtype or torch.float32
+            ids, inverse = torch.unique(input, return_inverse=True)
+            rows = dequantize_tensor_index(self.weight, ids.to(self.weight.device), dtype, self.dequant_dtype)
+            return rows.to(input.device)[inverse]
+
     class LayerNorm(GGMLLayer, comfy.ops.manual_cast.LayerNorm):
         def forward_ggml_cast_weights(self, input):
             if self.weight is None:
@@ -241,6 +444,86 @@ class GGMLOps(comfy.ops.manual_cast):
             weight, bias = self.cast_bias_weight(input)
             return torch.nn.functional.group_norm(input, self.num_groups, weight, bias, self.eps)
 
+class BlockPrefetcher:
+    """
+    Dequantize the weights of the next block(s) on a worker thread while the current one runs
+    """
+    def __init__(self, blocks, lookahead=1):
+        self.lookahead = max(1, min(lookahead, len(blocks) - 1))
+        self.layers = []
+        for block in blocks:
+            layers = [m for m in block.modules() if isinstance(m, GGMLLayer) and m.is_ggml_quantized() and not m.can_tile()]
+            for m in layers:
+                m.prefetched = {}
+                m.prefetch_requests = {}
+            self.layers.append(layers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="gguf_prefetch")
+        self.pending = {}
+        self.streams = {}
+        self.handles = []
+        self.enabled = True
+        self.prefetches = 0
+
+    def install(self, blocks):
+        for i, block in enumerate(blocks):
+            self.handles.append(block.register_forward_pre_hook(lambda module, args, i=i: self.on_block(i)))
+        return self
+
+    def on_block(self, i):
+        if not self.enabled:
+            return
+        future = self.pending.pop(i, None)
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"GGUF prefetch failed, disabling: {e}")
+                self.enabled = False
+                return
+        # wraps around so the first block of the next step is ready as well
+        n = len(self.layers)
+        for j in range(i + 1, i + 1 + self.lookahead):
+            j = j % n
+            if j not in self.pending and self.layers[j]:
+                self.pending[j] = self.executor.submit(self.prefetch_block, j)
+
+    def prefetch_block(self, i):
+        for m in self.layers[i]:
+            m.prefetch(self.get_stream(m))
+        self.prefetches += 1
+
+    def get_stream(self, layer):
+        request = layer.prefetch_requests.get("weight")
+        if request is None or request[2].type != "cuda":
+            return None
+        device = request[2]
+        if device not in self.streams:
+            self.streams[device] = torch.cuda.Stream(device)
+        return self.streams[device]
+
+    def clear(self):
+        # patches change between runs, drop anything dequantized ahead of time
+        for future in self.pending.values():
+            future.cancel()
+        concurrent.futures.wait(list(self.pending.values()))
+        self.pending.clear()
+        for layers in self.layers:
+            for m in layers:
+                m.prefetched.clear()
+
+    def remove(self):
+        self.clear()
+        for handle in self.handles:
+            handle.remove()
+        for layers in self.layers:
+            for m in layers:
+                m.prefetched = None
+                m.prefetch_requests = None
+        self.executor.shutdown(wait=True)
+
+    def __repr__(self):
+        return f"BlockPrefetcher(blocks={len(self.layers)}, lookahead={self.lookahead}, prefetches={self.prefetches})"
+
 def move_patch_to_device(item, device):
     if isinstance(item, torch.Tensor):
         return item.to(device, non_blocking=True)
@@ -0,0 +1,167 @@
+# Torch GGML encoders, the counterpart of the block kernels in dequant.py
+import gguf
+import torch
+
+from .dequant import QK_K
+
+def quantize(data, qtype):
+    """
+    Quantize a float tensor to GGML blocks, returns (rows, bytes per row) uint8
+    """
+    block_size, type_size = gguf.GGML_QUANT_SIZES[qtype]
+    quantize_blocks = quantize_functions[qtype]
+
+    rows = data.reshape((-1, data.shape[-1])).to(torch.float32)
+    if rows.shape[-1] % block_size != 0:
+        raise ValueError(f"Row size {rows.shape[-1]} is not a multiple of the {qtype.name} block size {block_size}")
+
+    n_blocks = rows.numel() // block_size
+    blocks = quantize_blocks(rows.reshape((n_blocks, block_size)))
+    return blocks.reshape((rows.shape[0], -1))
+
+def quantize_tensor(tensor, qtype):
+    """
+    Quantize a 2D (or higher) weight along its first dim, returns the raw blocks
+    """
+    rows = tensor.reshape((tensor.shape[0], -1))
+    return quantize(rows, qtype)
+
+def f16_bytes(x):
+    return x.to(torch.float16).view(torch.uint8).reshape((x.shape[0], -1))
+
+def safe_div(x, d):
+    return torch.where(d == 0, torch.zeros_like(x), x / torch.where(d == 0, torch.ones_like(d), d))
+
+# Legacy Quants #
+def quantize_blocks_Q8_0(blocks):
+    d = blocks.abs().amax(dim=-1, keepdim=True) / 127
+    qs = safe_div(blocks, d).round().clamp(-127, 127).to(torch.int8)
+    return torch.cat([f16_bytes(d), qs.view(torch.uint8)], dim=-1)
+
+# K Quants #
+def make_qkx2_quants(x, nmax, rmin=-1.0, rdelta=0.1, nstep=20):
+    """
+    Affine (scale, positive min) per row of x searched like llama.cpp's make_qkx2_quants
+    """
+    weights = x.square().mean(dim=-1, keepdim=True).sqrt() + x.abs()
+    x_min = x.amin(dim=-1, keepdim=True).clamp(max=0)
+    x_range = x.amax(dim=-1, keepdim=True) - x_min
+    sum_w = weights.sum(dim=-1, keepdim=True)
+    sum_x = (weights * x).sum(dim=-1, keepdim=True)
+    sum_x2 = (weights * x * x).sum(dim=-1, keepdim=True)
+
+    def fit(l):
+        # weighted sums of the levels, the squared error of any (scale, min) follows from them
+        wl = weights * l
+        return wl.sum(dim=-1, keepdim=True), (wl * l).sum(dim=-1, keepdim=True), (wl * x).sum(dim=-1, keepdim=True)
+
+    def error(scale, mn, sum_l, sum_l2, sum_xl):
+        return scale * scale * sum_l2 + mn * mn * sum_w + sum_x2 + 2 * scale * mn * sum_l - 2 * scale * sum_xl - 2 * mn * sum_x
+
+    # start from plain min/max, then try slightly different grid sizes and keep the least squares fit
+    best_scale, best_min = x_range / nmax, x_min
+    best_err = error(best_scale, best_min, *fit(safe_div(x - x_min, best_scale).round().clamp(0, nmax)))
+    for step in range(nstep + 1):
+        iscale = safe_div(torch.full_like(x_range, rmin + rdelta * step + nmax), x_range)
+        sum_l, sum_l2, sum_xl = fit((iscale * (x - x_min)).round_().clamp_(0, nmax))
+        D = sum_w * sum_l2 - sum_l * sum_l
+        scale = safe_div(sum_w * sum_xl - sum_x * sum_l, D)
+        mn = safe_div(sum_l2 * sum_x - sum_l * sum_xl, D)
+        # the min is stored as a non-negative offset, refit the scale alone when the fit wants one above 0
+        positive = mn > 0
+        scale = torch.where(positive, safe_div(sum_xl, sum_l2), scale)
+        mn = torch.where(positive, torch.zeros_like(mn), mn)
+        err = error(scale, mn, sum_l, sum_l2, sum_xl)
+        better = (D > 0) & (err < best_err)
+        best_err = torch.where(better, err, best_err)
+        best_scale = torch.where(better, scale, best_scale)
+        best_min = torch.where(better, mn, best_min)
+    return best_scale.squeeze(-1), -best_min.squeeze(-1)
+
+def make_qx_quants(x, nmax, nstep=9):
+    """
+    Signed scale per row of x searched like llama.cpp's make_qx_quants (values in [-nmax, nmax - 1])
+    """
+    weights = x.square()
+    idx = x.abs().argmax(dim=-1, keepdim=True)
+    x_max = torch.gather(x, -1, idx)
+
+    best_scale, best_score = None, None
+    for step in range(-nstep, nstep + 1):
+        iscale = safe_div(torch.full_like(x_max, -(nmax + 0.1 * step)), x_max)
+        l = (iscale * x).round_().clamp_(-nmax, nmax - 1)
+        wl = weights * l
+        sum_lx = (wl * x).sum(dim=-1, keepdim=True)
+        sum_l2 = (wl * l).sum(dim=-1, keepdim=True)
+        # the least squares scale for these levels and how much of x it explains
+        scale = safe_div(sum_lx, sum_l2)
+        score = scale * sum_lx
+        if best_score is None:
+            best_scale, best_score = scale, score
+            continue
+        better = score > best_score
+        best_score = torch.where(better, score, best_score)
+        best_scale = torch.where(better, scale, best_scale)
+    return best_scale.squeeze(-1)
+
+def pack_scale_min_k4(sc, m):
+    # inverse of dequant.get_scale_min, 8x 6 bit scales and mins into 12 bytes
+    d = (sc[:, :4] & 0x3F) | ((sc[:, 4:] >> 4) << 6)
+    m_ = (m[:, :4] & 0x3F) | ((m[:, 4:] >> 4) << 6)
+    m_d = (sc[:, 4:] & 0x0F) | ((m[:, 4:] & 0x0F) << 4)
+    return torch.cat([d, m_, m_d], dim=-1)
+
+def quantize_blocks_Q6_K(blocks):
+    n_blocks = blocks.shape[0]
+    x = blocks.reshape((n_blocks, QK_K // 16, 16))
+
+    # signed scale per 16 values, searched around the one that maps the largest magnitude to -32
+    scale = make_qx_quants(x, 32)
+
+    d = scale.abs().amax(dim=-1, keepdim=True) / 127
+    d = d.to(torch.float16).to(torch.float32)
+    scales = safe_div(scale, d).round().clamp(-127, 127)
+
+    q = safe_div(x, (d * scales).unsqueeze(-1)).round().clamp(-32, 31) + 32
+    q = q.to(torch.uint8).reshape((n_blocks, QK_K))
+
+    lo = (q & 0x0F).reshape((n_blocks, 2, 2, 64))
+    hi = (q >> 4).reshape((n_blocks, 2, 4, 32))
+    ql = lo[:, :, 0] | (lo[:, :, 1] << 4)
+    qh = hi[:, :, 0] | (hi[:, :, 1] << 2) | (hi[:, :, 2] << 4) | (hi[:, :, 3] << 6)
+
+    return torch.cat([
+        ql.reshape((n_blocks, -1)),
+        qh.reshape((n_blocks, -1)),
+        scales.to(torch.int8).view(torch.uint8),
+        f16_bytes(d),
+    ], dim=-1)
+
+def quantize_blocks_Q4_K(blocks):
+    n_blocks = blocks.shape[0]
+    x = blocks.reshape((n_blocks, QK_K // 32, 32))
+
+    # affine per 32 values, the offset is stored as a positive min
+    scale, mn = make_qkx2_quants(x, 15)
+
+    d = (scale.amax(dim=-1, keepdim=True) / 63).to(torch.float16).to(torch.float32)
+    dmin = (mn.amax(dim=-1, keepdim=True) / 63).to(torch.float16).to(torch.float32)
+    sc = safe_div(scale, d).round().clamp(0, 63)
+    m = safe_div(mn, dmin).round().clamp(0, 63)
+
+    q = safe_div(x + (dmin * m).unsqueeze(-1), (d * sc).unsqueeze(-1)).round().clamp(0, 15)
+    q = q.to(torch.uint8).reshape((n_blocks, 4, 2, 32))
+    qs = q[:, :, 0] | (q[:, :, 1] << 4)
+
+    return torch.cat([
+        f16_bytes(d),
+        f16_bytes(dmin),
+        pack_scale_min_k4(sc.to(torch.uint8), m.to(torch.uint8)),
+        qs.reshape((n_blocks, -1)),
+    ], dim=-1)
+
+quantize_functions = {
+    gguf.GGMLQuantizationType.Q8_0: quantize_blocks_Q8_0,
+    gguf.GGMLQuantizationType.Q6_K: quantize_blocks_Q6_K,
+    gguf.GGMLQuantizationType.Q4_K: quantize_blocks_Q4_K,
+}
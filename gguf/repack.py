@@ -0,0 +1,140 @@
+# On-disk cache of GGUF weights repacked into a layout that is cheap to decode
+import os
+import json
+import glob
+import shutil
+
+import gguf
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from .ops import GGMLTensor
+from .dequant import dequantize_tensor, is_quantized
+from .quant import quantize_tensor
+from .index import file_fingerprint, remove_stale_caches
+
+# requant_q8_0 re-quantizes (lossy against the source), fp16 stores the dequantized weights
+REPACK_POLICIES = ["requant_q8_0", "fp16"]
+REPACK_VERSION = 1
+
+# tensors smaller than this are stored as fp16, the int8 blocks are not worth it
+REPACK_MIN_INT8_NUMEL = 1024 * 1024
+REPACK_ALIGN = 64
+
+def repack_tensor(tensor, policy):
+    """
+    Returns the repacked tensor type and raw numpy data for a single GGMLTensor
+    """
+    qtype = getattr(tensor, "tensor_type", None)
+    shape = tuple(getattr(tensor, "tensor_shape", tensor.shape))
+    if not is_quantized(tensor):
+        return qtype, tensor.data.cpu().numpy()
+
+    numel = int(np.prod(shape))
+    block_size, _ = gguf.GGML_QUANT_SIZES[gguf.GGMLQuantizationType.Q8_0]
+    int8 = (
+        policy == "requant_q8_0" and len(shape) >= 2 and numel >= REPACK_MIN_INT8_NUMEL
+        and (numel // shape[0]) % block_size == 0
+    )
+    if int8 and qtype == gguf.GGMLQuantizationType.Q8_0:
+        return qtype, tensor.data.cpu().numpy()
+    if int8:
+        # Q8_0 is a plain int8 matrix with one fp16 scale per 32 values, the cheapest layout to decode.
+        # Not a copy of the source weights: every other qtype is rounded again (and Q4/Q5 about double in size)
+        weight = dequantize_tensor(tensor, dtype=torch.float32).reshape(shape[0], -1)
+        return gguf.GGMLQuantizationType.Q8_0, quantize_tensor(weight, gguf.GGMLQuantizationType.Q8_0).numpy()
+    weight = dequantize_tensor(tensor, dtype=torch.float16)
+    return gguf.GGMLQuantizationType.F16, weight.numpy()
+
+def write_repacked(state_dict, target, policy, source):
+    tmp = target + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    entries = []
+    offset = 0
+    with open(os.path.join(tmp, "weights.bin"), "wb") as f:
+        for key, tensor in tqdm(state_dict.items(), desc=f"Repacking GGUF ({policy})"):
+            qtype, data = repack_tensor(tensor, policy)
+            data = np.ascontiguousarray(data)
+            pad = -offset % REPACK_ALIGN
+            f.write(b"\0" * pad)
+            offset += pad
+            f.write(data.tobytes())
+            entries.append({
+                "key": key,
+                "type": getattr(qtype, "name", None),
+                "shape": list(getattr(tensor, "tensor_shape", tensor.shape)),
+                "raw_shape": list(data.shape),
+                "dtype": data.dtype.str,
+                "offset": offset,
+            })
+            offset += data.nbytes
+
+    index = {"version": REPACK_VERSION, "source": os.path.basename(source), "policy": policy, "tensors": entries}
+    with open(os.path.join(tmp, "index.json"), "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, target)
+
+def read_repacked(target):
+    with open(os.path.join(target, "index.json")) as f:
+        index = json.load(f)
+    data = np.memmap(os.path.join(target, "weights.bin"), dtype=np.uint8, mode="r")
+
+    state_dict = {}
+    qtype_dict = {}
+    for entry in index["tensors"]:
+        dtype = np.dtype(entry["dtype"])
+        nbytes = int(np.prod(entry["raw_shape"])) * dtype.itemsize
+        raw = data[entry["offset"]:entry["offset"] + nbytes].view(dtype).reshape(entry["raw_shape"])
+        qtype = gguf.GGMLQuantizationType[entry["type"]] if entry["type"] is not None else None
+        shape = torch.Size(entry["shape"])
+        torch_tensor = torch.from_numpy(raw) # mmap
+        if qtype in {gguf.GGMLQuantizationType.F32, gguf.GGMLQuantizationType.F16}:
+            torch_tensor = torch_tensor.view(*shape)
+        state_dict[entry["key"]] = GGMLTensor(torch_tensor, tensor_type=qtype, tensor_shape=shape)
+
+        tensor_type_str = getattr(qtype, "name", repr(qtype))
+        qtype_dict[tensor_type_str] = qtype_dict.get(tensor_type_str, 0) + 1
+
+    print("gguf qtypes (repacked): " + ", ".join(f"{k} ({v})" for k, v in qtype_dict.items()))
+
+    # mark largest tensor for vram estimation
+    qsd = {k:v for k,v in state_dict.items() if is_quantized(v)}
+    if len(qsd) > 0:
+        max_key = max(qsd.keys(), key=lambda k: qsd[k].numel())
+        state_dict[max_key].is_largest_weight = True
+    return state_dict
+
+def is_valid_repack(target):
+    try:
+        with open(os.path.join(target, "index.json")) as f:
+            return json.load(f).get("version") == REPACK_VERSION
+    except (OSError, ValueError):
+        return False
+
+def gguf_repack_loader(path, policy, cache_dir, loader):
+    """
+    Load the repacked copy of a GGUF file, building it with `loader` on the first run
+    """
+    if policy not in REPACK_POLICIES:
+        raise ValueError(f"Unknown repack policy {policy!r}, expected one of {REPACK_POLICIES}")
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    target = os.path.join(cache_dir, f"{name}-{file_fingerprint(path)}-{policy}")
+    if not is_valid_repack(target):
+        state_dict = loader(path)
+        try:
+            write_repacked(state_dict, target, policy, path)
+        except Exception as e:
+            print(f"Failed to write GGUF repack cache, using the original file: {e}")
+            shutil.rmtree(target + ".tmp", ignore_errors=True)
+            return state_dict
+        del state_dict
+
+        for old in remove_stale_caches(target, f"{glob.escape(name)}-*-{policy}"):
+            print(f"Removed stale GGUF repack cache {old}")
+
+    print(f"Loading repacked GGUF from {target}")
+    return read_repacked(target)
@@ -0,0 +1,112 @@
+# Readahead / release hints for mmap-backed GGUF weights that stay on the offload device
+import mmap
+import concurrent.futures
+
+PAGE_SIZE = mmap.PAGESIZE
+HAS_MADVISE = hasattr(mmap.mmap, "madvise") and hasattr(mmap, "MADV_WILLNEED") and hasattr(mmap, "MADV_DONTNEED")
+
+def get_block_ranges(block):
+    """
+    Page aligned byte ranges of the block params that are still backed by the file
+    """
+    return get_source_ranges(block.parameters(recurse=True))
+
+def get_source_ranges(params):
+    # one (mm, start, end) span per backing file
+    ranges = {}
+    for p in params:
+        source = getattr(p, "source_range", None)
+        if source is None:
+            continue
+        mm, offset, nbytes = source
+        start = offset - offset % PAGE_SIZE
+        end = offset + nbytes
+        key = id(mm)
+        if key in ranges:
+            _, s, e = ranges[key]
+            start, end = min(start, s), max(end, e)
+        ranges[key] = (mm, start, end)
+    return list(ranges.values())
+
+class GGUFStreamer:
+    """
+    Ask the OS to read the next blocks ahead of time and drop the ones that ran
+    """
+    def __init__(self, blocks, readahead=2, keep_behind=1):
+        self.blocks = list(blocks)
+        self.readahead = readahead
+        self.keep_behind = keep_behind
+        self.resident = set()
+        self.handles = []
+        self.executor = None
+        if not HAS_MADVISE:
+            # no madvise (Windows), prefault pages from a worker thread instead
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="gguf_stream")
+
+    def install(self):
+        for i, block in enumerate(self.blocks):
+            self.handles.append(block.register_forward_pre_hook(lambda module, args, i=i: self.on_block(i)))
+        return self
+
+    def on_block(self, i):
+        n = len(self.blocks)
+        window = {(i + j) % n for j in range(-self.keep_behind, self.readahead + 1)}
+        for j in sorted(self.resident - window):
+            self.release(j)
+        for j in range(i + 1, i + 1 + self.readahead):
+            j = j % n
+            if j not in self.resident:
+                self.willneed(j)
+        self.resident = (self.resident & window) | {i % n}
+
+    def willneed(self, i):
+        ranges = get_block_ranges(self.blocks[i])
+        if not ranges:
+            return
+        self.resident.add(i)
+        for mm, start, end in ranges:
+            if HAS_MADVISE:
+                mm.madvise(mmap.MADV_WILLNEED, start, end - start)
+            else:
+                self.executor.submit(touch_pages, mm, start, end)
+
+    def release(self, i):
+        self.resident.discard(i)
+        if not HAS_MADVISE:
+            return
+        for mm, start, end in get_block_ranges(self.blocks[i]):
+            # clean file pages, re-reading them later just hits the page cache or disk
+            mm.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def __repr__(self):
+        mode = "madvise" if HAS_MADVISE else "prefault"
+        return f"GGUFStreamer(blocks={len(self.blocks)}, readahead={self.readahead}, mode={mode})"
+
+def touch_pages(mm, start, end):
+    # reading one byte per page faults the range in
+    return sum(mm[start:end:PAGE_SIZE])
+
+def prefetch_sources(params, chunk_size=256 * 1024 * 1024):
+    """
+    Start reading everything backing `params` at once, all files (split parts) in parallel
+    """
+    chunks = []
+    for mm, start, end in get_source_ranges(params):
+        for s in range(start, end, chunk_size):
+            chunks.append((mm, s, min(s + chunk_size, end)))
+    if not chunks:
+        return
+    if HAS_MADVISE:
+        # readahead is queued by the kernel, no need for threads
+        for mm, start, end in chunks:
+            mm.madvise(mmap.MADV_WILLNEED, start, end - start)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(chunks), 8), thread_name_prefix="gguf_read") as pool:
+        list(pool.map(lambda c: touch_pages(*c), chunks))
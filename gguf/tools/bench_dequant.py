@@ -0,0 +1,240 @@
+# Dequantization micro-benchmark and conformance check for gguf/dequant.py
+#
+#   python gguf/tools/bench_dequant.py --output bench_dequant.json
+#   python gguf/tools/bench_dequant.py --qtypes Q4_K Q8_0 --shapes 5120x13824 --dtype float32
+#   python gguf/tools/bench_dequant.py --tiled 100 --shapes 256x1024 --repeat 1
+#
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import importlib.metadata
+
+import gguf
+import numpy as np
+import torch
+
+# import the kernels without pulling in comfy through the package __init__
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dequant import dequantize, dequantize_tensor, dequantize_tensor_rows, dequantize_functions, workspace_stats
+
+# (out_features, in_features) of the linear layers in the Wan 2.1 blocks
+WAN_SHAPES = {
+    "14B attn": (5120, 5120),
+    "14B ffn_up": (13824, 5120),
+    "14B ffn_down": (5120, 13824),
+    "1.3B attn": (1536, 1536),
+    "1.3B ffn_up": (8960, 1536),
+    "1.3B ffn_down": (1536, 8960),
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the torch GGUF dequant kernels on CPU")
+    parser.add_argument("--qtypes", nargs="*", default=None, help="qtype names, defaults to every qtype with a torch kernel")
+    parser.add_argument("--shapes", nargs="*", default=None, help="OUTxIN layer shapes, defaults to the Wan 2.1 linear shapes")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--check-rows", type=int, default=256, help="rows compared against gguf-py per shape, 0 skips the check")
+    parser.add_argument("--tiled", type=int, default=0, help="also check the tiled linear path (tile_rows) against the full weight, 0 skips it")
+    parser.add_argument("--output", default=None, help="write results as json")
+    parser.add_argument("--baseline", default=None, help="json from a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown vs baseline reported as a regression")
+    return parser.parse_args()
+
+def get_shapes(args):
+    if not args.shapes:
+        return list(WAN_SHAPES.items())
+    shapes = []
+    for s in args.shapes:
+        out_features, in_features = (int(x) for x in s.lower().split("x"))
+        shapes.append((s, (out_features, in_features)))
+    return shapes
+
+def make_blocks(qtype, shape, seed=0):
+    """
+    Build raw quantized rows, real quantized weights where gguf-py can encode the qtype
+    """
+    rng = np.random.default_rng(seed)
+    try:
+        weight = (rng.standard_normal(shape, dtype=np.float32) * 0.02).astype(np.float32)
+        return gguf.quants.quantize(weight, qtype)
+    except (NotImplementedError, gguf.quants.QuantError, KeyError):
+        pass
+    # random payload, fp16 scales might end up as nan/inf but the kernel cost is the same
+    block_size, type_size = gguf.GGML_QUANT_SIZES[qtype]
+    row_bytes = shape[1] // block_size * type_size
+    return rng.integers(0, 256, size=(shape[0], row_bytes), dtype=np.uint8)
+
+def dequantize_reference(raw, qtype):
+    """
+    gguf.quants.dequantize, plus d * qs for Q8_K which gguf-py doesn't implement
+    """
+    if qtype == gguf.GGMLQuantizationType.Q8_K:
+        block_size, type_size = gguf.GGML_QUANT_SIZES[qtype]
+        blocks = raw.reshape(-1, type_size)
+        d = blocks[:, :4].copy().view(np.float32)
+        qs = blocks[:, 4:4 + block_size].copy().view(np.int8).astype(np.float32)
+        return d * qs
+    return gguf.quants.dequantize(raw, qtype)
+
+def check_conformance(qtype, raw, shape, rows):
+    """
+    Compare the torch kernel in fp32 against the reference
+    """
+    raw = raw[:rows]
+    with np.errstate(invalid="ignore", over="ignore"):
+        try:
+            ref = dequantize_reference(raw, qtype)
+        except NotImplementedError:
+            return None
+    out = dequantize(torch.from_numpy(raw), qtype, (raw.shape[0], shape[1]), dtype=torch.float32).numpy()
+    return bool(np.array_equal(out, ref.reshape(out.shape), equal_nan=True))
+
+def linear_tiled(input, weight, bias, tile_rows, dtype):
+    """
+    Same tiling as GGMLOps.Linear.forward_ggml_tiled, without the comfy casts
+    """
+    out_features = weight.tensor_shape[0]
+    out = torch.empty((*input.shape[:-1], out_features), dtype=dtype)
+    for start in range(0, out_features, tile_rows):
+        end = min(start + tile_rows, out_features)
+        tile = dequantize_tensor_rows(weight, start, end, dtype)
+        out[..., start:end] = torch.nn.functional.linear(input, tile, bias[start:end])
+    return out
+
+def check_tiled(qtype, raw, shape, rows, tile_rows, dtype):
+    """
+    Tiled dequant must give the exact full weight, the tiled linear the full linear output
+    """
+    raw = raw[:rows]
+    weight = torch.from_numpy(raw)
+    weight.tensor_type = qtype
+    weight.tensor_shape = torch.Size((raw.shape[0], shape[1]))
+    # the full weight as the untiled forward builds it
+    full = dequantize_tensor(weight, dtype)
+
+    tiles = [dequantize_tensor_rows(weight, start, min(start + tile_rows, raw.shape[0]), dtype) for start in range(0, raw.shape[0], tile_rows)]
+    if not torch.equal(torch.cat(tiles).nan_to_num(), full.nan_to_num()):
+        return False
+
+    gen = torch.Generator().manual_seed(0)
+    input = torch.randn((2, 3, shape[1]), generator=gen).to(dtype)
+    bias = torch.randn(raw.shape[0], generator=gen).to(dtype)
+    ref = torch.nn.functional.linear(input, full, bias)
+    out = linear_tiled(input, weight, bias, tile_rows, dtype)
+    # different gemm shapes may sum in a different order
+    tolerance = 1e-5 if dtype == torch.float32 else 1e-2
+    return bool(torch.allclose(out.float(), ref.float(), rtol=tolerance, atol=tolerance, equal_nan=True))
+
+def bench(qtype, raw, shape, dtype, repeat, warmup):
+    data = torch.from_numpy(raw)
+    for _ in range(warmup):
+        dequantize(data, qtype, shape, dtype=dtype)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = dequantize(data, qtype, shape, dtype=dtype)
+        times.append(time.perf_counter() - start)
+        del out
+
+    elements = shape[0] * shape[1]
+    in_bytes = raw.nbytes
+    out_bytes = elements * torch.empty(0, dtype=dtype).element_size()
+    median = float(np.median(times))
+    return {
+        "seconds_median": median,
+        "seconds_min": float(min(times)),
+        "elements_per_s": elements / median,
+        "gb_per_s": (in_bytes + out_bytes) / median / 1e9,
+        "input_gb_per_s": in_bytes / median / 1e9,
+        "input_bytes": in_bytes,
+        "output_bytes": out_bytes,
+    }
+
+def compare_baseline(results, path, tolerance):
+    with open(path) as f:
+        baseline = json.load(f)
+    previous = {(r["qtype"], tuple(r["shape"]), r["dtype"]): r for r in baseline["results"]}
+
+    regressions = []
+    for r in results:
+        prev = previous.get((r["qtype"], tuple(r["shape"]), r["dtype"]))
+        if prev is None:
+            continue
+        ratio = r["seconds_median"] / prev["seconds_median"]
+        r["baseline_ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(f"{r['qtype']} {r['shape_name']} {ratio:.2f}x slower")
+    return regressions
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    qtypes = list(dequantize_functions.keys())
+    if args.qtypes:
+        qtypes = [gguf.GGMLQuantizationType[name.upper()] for name in args.qtypes]
+    dtype = getattr(torch, args.dtype)
+
+    results = []
+    failed = []
+    for qtype in qtypes:
+        block_size, _ = gguf.GGML_QUANT_SIZES[qtype]
+        for name, shape in get_shapes(args):
+            if shape[1] % block_size != 0:
+                continue
+            raw = make_blocks(qtype, shape)
+            result = {"qtype": qtype.name, "shape_name": name, "shape": list(shape), "dtype": args.dtype}
+            result.update(bench(qtype, raw, shape, dtype, args.repeat, args.warmup))
+            result["conformant"] = check_conformance(qtype, raw, shape, args.check_rows) if args.check_rows > 0 else None
+            result["tiled"] = check_tiled(qtype, raw, shape, args.check_rows or shape[0], args.tiled, dtype) if args.tiled > 0 else None
+            if result["conformant"] is False:
+                failed.append(f"{qtype.name} {name}")
+            if result["tiled"] is False:
+                failed.append(f"{qtype.name} {name} tiled")
+            results.append(result)
+
+            conformant = {True: "ok", False: "MISMATCH", None: "-"}[result["conformant"]]
+            if args.tiled > 0:
+                conformant += " tiled " + {True: "ok", False: "MISMATCH"}[result["tiled"]]
+            print(
+                f"{qtype.name:>8} {name:>14} {shape[0]:>6}x{shape[1]:<6} "
+                f"{result['seconds_median'] * 1000:9.2f} ms {result['gb_per_s']:7.2f} GB/s "
+                f"{result['elements_per_s'] / 1e9:6.2f} Gelem/s  {conformant}"
+            )
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "torch": torch.__version__,
+            "gguf": importlib.metadata.version("gguf"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "threads": torch.get_num_threads(),
+            "device": "cpu",
+        },
+        "results": results,
+        "workspace": workspace_stats(),
+    }
+    regressions = compare_baseline(results, args.baseline, args.tolerance) if args.baseline else []
+    for r in regressions:
+        print(f"regression: {r}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {len(results)} results to {args.output}")
+
+    if failed:
+        print("check failed: " + ", ".join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
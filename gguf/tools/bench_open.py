@@ -0,0 +1,132 @@
+# Open-to-state-dict latency of a GGUF file, header parse vs the sidecar index in gguf/index.py
+#
+#   python gguf/tools/bench_open.py --size-gb 4
+#   python gguf/tools/bench_open.py --path models/unet/wan2.1-t2v-14b-Q4_K_M.gguf
+#
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+
+import gguf
+import numpy as np
+import torch
+
+# import the index without pulling in comfy through the package __init__
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from index import get_orig_shapes, tensor_infos_from_reader, load_tensor_index, save_tensor_index
+
+# (name, out_features, in_features) of the quantized weights in one Wan 2.1 14B block
+WAN_BLOCK = [
+    *[(f"self_attn.{n}", 5120, 5120) for n in "qkvo"],
+    *[(f"cross_attn.{n}", 5120, 5120) for n in "qkvo"],
+    ("ffn.0", 13824, 5120),
+    ("ffn.2", 5120, 13824),
+]
+WAN_SMALL = ["self_attn.norm_q", "self_attn.norm_k", "cross_attn.norm_q", "cross_attn.norm_k", "norm3"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark GGUF open latency with and without the sidecar index")
+    parser.add_argument("--path", default=None, help="existing GGUF file, a synthetic Wan-like file is written otherwise")
+    parser.add_argument("--size-gb", type=float, default=4.0, help="approximate size of the synthetic file")
+    parser.add_argument("--qtype", default="Q8_0")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tmp-dir", default=None)
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    return parser.parse_args()
+
+def write_synthetic(path, size_gb, qtype):
+    block_size, type_size = gguf.GGML_QUANT_SIZES[qtype]
+    block_bytes = sum(o * i // block_size * type_size for _, o, i in WAN_BLOCK)
+    n_blocks = max(1, round(size_gb * 1024 ** 3 / block_bytes))
+
+    # tensors of the same shape share one buffer, the content doesn't matter here
+    buffers = {}
+    def raw(o, i):
+        if (o, i) not in buffers:
+            buffers[(o, i)] = np.zeros((o, i // block_size * type_size), dtype=np.uint8)
+        return buffers[(o, i)]
+
+    writer = gguf.GGUFWriter(path, "wan")
+    writer.add_tensor("patch_embedding.weight", np.zeros((5120, 64), dtype=np.float16))
+    writer.add_array("comfy.gguf.orig_shape.patch_embedding.weight", [5120, 16, 1, 2, 2])
+    for b in range(n_blocks):
+        for name, o, i in WAN_BLOCK:
+            writer.add_tensor(f"blocks.{b}.{name}.weight", raw(o, i), raw_dtype=qtype)
+            writer.add_tensor(f"blocks.{b}.{name}.bias", np.zeros(o, dtype=np.float32))
+        for name in WAN_SMALL:
+            writer.add_tensor(f"blocks.{b}.{name}.weight", np.zeros(5120, dtype=np.float32))
+        writer.add_tensor(f"blocks.{b}.modulation", np.zeros((1, 6, 5120), dtype=np.float32))
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+
+def open_with_reader(path):
+    reader = gguf.GGUFReader(path)
+    reader.get_field("general.architecture")
+    orig_shapes = get_orig_shapes(reader)
+    infos = tensor_infos_from_reader(reader, orig_shapes)
+    return (infos, orig_shapes), {info["name"]: torch.from_numpy(info["data"]) for info in infos}
+
+def open_with_index(path, index_dir):
+    _, infos, _ = load_tensor_index(path, index_dir)
+    return infos, {info["name"]: torch.from_numpy(info["data"]) for info in infos}
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times), min(times)
+
+def main():
+    args = parse_args()
+    qtype = gguf.GGMLQuantizationType[args.qtype.upper()]
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        path = args.path
+        if path is None:
+            path = os.path.join(tmp_dir, "synthetic.gguf")
+            start = time.perf_counter()
+            write_synthetic(path, args.size_gb, qtype)
+            print(f"wrote {os.path.getsize(path) / 1024 ** 3:.2f} GB synthetic GGUF in {time.perf_counter() - start:.1f}s")
+        index_dir = os.path.join(tmp_dir, "index")
+
+        ((infos, orig_shapes), ref), reader_med, reader_min = timed(lambda: open_with_reader(path), args.repeat)
+        start = time.perf_counter()
+        save_tensor_index(path, index_dir, "wan", infos, orig_shapes)
+        build = time.perf_counter() - start
+        (_, sd), index_med, index_min = timed(lambda: open_with_index(path, index_dir), args.repeat)
+
+        # the index has to describe exactly the same tensors
+        assert ref.keys() == sd.keys()
+        for k in ref:
+            assert ref[k].shape == sd[k].shape and ref[k].dtype == sd[k].dtype and torch.equal(ref[k][:1], sd[k][:1])
+
+        print(f"{len(sd)} tensors, {os.path.getsize(path) / 1024 ** 3:.2f} GB")
+        print(f"  reader  {reader_med * 1000:9.1f} ms (min {reader_min * 1000:.1f})")
+        print(f"  index   {index_med * 1000:9.1f} ms (min {index_min * 1000:.1f}), built in {build * 1000:.1f} ms")
+        print(f"  speedup {reader_med / index_med:9.1f}x")
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({
+                    "path": args.path or "synthetic",
+                    "size_bytes": os.path.getsize(path),
+                    "tensors": len(sd),
+                    "reader_seconds_median": reader_med,
+                    "index_seconds_median": index_med,
+                    "index_build_seconds": build,
+                    "torch": torch.__version__,
+                }, f, indent=2)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# One contiguous (pinned when possible) host buffer that offloaded weights live in as views
+import torch
+
+ARENA_ALIGN = 256
+
+def can_pin_memory():
+    return torch.cuda.is_available()
+
+def module_tensors(module):
+    """
+    (owner module, name, is buffer) for every param and buffer, shared tensors only once
+    """
+    seen = set()
+    entries = []
+    for m in module.modules():
+        for name, t in m._parameters.items():
+            if t is not None and id(t) not in seen:
+                seen.add(id(t))
+                entries.append((m, name, False))
+        for name, t in m._buffers.items():
+            if t is not None and id(t) not in seen:
+                seen.add(id(t))
+                entries.append((m, name, True))
+    return entries
+
+def point_to(t, buffer, offset):
+    # swap .data so the param object (and any attrs on it) stays the same,
+    # set_ would refuse a host storage while the tensor is still on the GPU
+    nbytes = t.numel() * t.element_size()
+    t.data = buffer[offset:offset + nbytes].view(t.dtype).view(t.size())
+
+class HostArena:
+    """
+    Offloaded weights as views into one host buffer, offloading again only re-points them
+    """
+    def __init__(self, tensors, pin=None):
+        self.tensors = {}
+        offset = 0
+        for t in tensors:
+            if id(t) in self.tensors:
+                continue
+            offset += -offset % ARENA_ALIGN
+            nbytes = t.numel() * t.element_size()
+            self.tensors[id(t)] = (t, offset, nbytes)
+            offset += nbytes
+
+        self.pinned = False
+        pin = can_pin_memory() if pin is None else pin
+        self.buffer = None
+        if pin:
+            try:
+                self.buffer = torch.empty(offset, dtype=torch.uint8, pin_memory=True)
+                self.pinned = True
+            except RuntimeError as e:
+                print(f"Failed to pin {offset / 1024 ** 3:.2f} GB host arena, using pageable memory: {e}")
+        if self.buffer is None:
+            self.buffer = torch.empty(offset, dtype=torch.uint8)
+
+        for t, offset, nbytes in self.tensors.values():
+            if nbytes > 0:
+                self.buffer[offset:offset + nbytes].copy_(t.detach().reshape(-1).view(torch.uint8))
+            point_to(t, self.buffer, offset)
+
+    @property
+    def nbytes(self):
+        return self.buffer.numel()
+
+    def owns(self, t):
+        entry = self.tensors.get(id(t))
+        return entry is not None and entry[0] is t and entry[2] == t.numel() * t.element_size()
+
+    def offload(self, t):
+        """
+        Weights are read-only, the host copy is still valid so nothing has to be copied back
+        """
+        _, offset, _ = self.tensors[id(t)]
+        if t.device.type != "cpu" or t.untyped_storage().data_ptr() != self.buffer.data_ptr():
+            point_to(t, self.buffer, offset)
+
+    def __repr__(self):
+        return f"HostArena({len(self.tensors)} tensors, {self.nbytes / 1024 ** 3:.2f} GB, pinned={self.pinned})"
+
+def offload_module(module, device, pin=None):
+    """
+    Like module.to(device), but cpu offloads go through the module's host arena
+    """
+    if torch.device(device).type != "cpu":
+        return module.to(device)
+
+    arena = getattr(module, "host_arena", None)
+    if arena is None:
+        tensors = [getattr(m, name) for m, name, _ in module_tensors(module)]
+        module.host_arena = arena = HostArena(tensors, pin=pin)
+        print(f"Offloaded {module.__class__.__name__} into {arena}")
+        return module
+
+    for m, name, _ in module_tensors(module):
+        t = getattr(m, name)
+        if arena.owns(t):
+            arena.offload(t)
+        else:
+            # replaced since the arena was built (i.e. patched), move it the usual way
+            t.data = t.data.to(device)
+    return module
@@ -7,7 +7,6 @@ from comfy.ldm.modules.attention import optimized_attention
 from comfy.ldm.flux.math import apply_rope
 from comfy.samplers import sampling_function, CFGGuider
 from .utils import find_step_index_percent
-from einops import rearrange
 
 def skip_layer_guidance(model, blocks, start_percent, end_percent):
     block_list = [int(x.strip()) for x in blocks.split(",")]
@@ -126,7 +125,15 @@ def modified_wan_self_attention_forward(self, x, freqs):
 
     q, k = apply_rope(q, k, freqs)
 
-    feta_scores = get_feta_scores(q, k, self.num_frames, self.enhance_weight)
+    if self.feta_compute or self.feta_shared.get("score") is None:
+        feta_scores = get_feta_scores(q, k, self.num_frames, self.enhance_weight, self.feta_stride)
+        self.feta_shared["score"] = feta_scores
+    else:
+        # computed by an earlier block of this step
+        feta_scores = self.feta_shared["score"]
+
+    if FETA_CHECK:
+        check_feta_scores(self.feta_shared, feta_scores, get_feta_scores(q, k, self.num_frames, self.enhance_weight))
 
     x = optimized_attention(
         q.view(b, s, n * d),
@@ -141,64 +148,69 @@ def modified_wan_self_attention_forward(self, x, freqs):
 
     return x
     
-def get_feta_scores(query, key, num_frames, enhance_weight):
-    img_q, img_k = query, key #torch.Size([2, 9216, 12, 128])
-    
-    _, ST, num_heads, head_dim = img_q.shape
-    spatial_dim = ST / num_frames
-    spatial_dim = int(spatial_dim)
-
-    query_image = rearrange(
-        img_q, "B (T S) N C -> (B S) N T C", T=num_frames, S=spatial_dim, N=num_heads, C=head_dim
-    )
-    key_image = rearrange(
-        img_k, "B (T S) N C -> (B S) N T C", T=num_frames, S=spatial_dim, N=num_heads, C=head_dim
-    )
+# also compute the full (stride 1, per block) score and print how far the used one is off, per step
+FETA_CHECK = False
 
-    return feta_score(query_image, key_image, head_dim, num_frames, enhance_weight)
+def check_feta_scores(shared, used, exact):
+    deviations = shared.setdefault("deviations", [])
+    deviations.append(((used - exact).abs() / exact).item())
+    if len(deviations) == shared["blocks"]:
+        print(f"enhance score deviation from the full score: max {max(deviations):.2%}, mean {sum(deviations) / len(deviations):.2%}")
+        deviations.clear()
 
-def feta_score(query_image, key_image, head_dim, num_frames, enhance_weight):
-    scale = head_dim**-0.5
-    query_image = query_image * scale
-    attn_temp = query_image @ key_image.transpose(-2, -1)  # translate attn to float32
-    attn_temp = attn_temp.to(torch.float32)
-    attn_temp = attn_temp.softmax(dim=-1)
+# temporaries per block of spatial tokens in `get_feta_scores`
+FETA_BLOCK_BYTES = 64 * 1024 * 1024
 
-    # Reshape to [batch_size * num_tokens, num_frames, num_frames]
-    attn_temp = attn_temp.reshape(-1, num_frames, num_frames)
-
-    # Create a mask for diagonal elements
-    diag_mask = torch.eye(num_frames, device=attn_temp.device).bool()
-    diag_mask = diag_mask.unsqueeze(0).expand(attn_temp.shape[0], -1, -1)
-
-    # Zero out diagonal elements
-    attn_wo_diag = attn_temp.masked_fill(diag_mask, 0)
+def get_feta_scores(query, key, num_frames, enhance_weight, stride=1):
+    """
+    FETA enhance score from the q/k views in blocks of spatial tokens, without rearranged copies of q/k
+    """
+    b, s, n, d = query.shape
+    spatial_dim = s // num_frames
+    q = query.view(b, num_frames, spatial_dim, n, d)[:, :, ::stride, ::stride]
+    k = key.view(b, num_frames, spatial_dim, n, d)[:, :, ::stride, ::stride]
+    spatial_dim, n = q.shape[2], q.shape[3]
+
+    # per spatial token: the q/k slices [T, d] and the float32 T x T scores (twice for the softmax), for every head
+    token_bytes = b * n * (2 * num_frames * d * query.element_size() + 2 * num_frames * num_frames * 4)
+    block = max(1, FETA_BLOCK_BYTES // token_bytes)
+    off_diag = torch.zeros((), dtype=torch.float32, device=query.device)
+    for start in range(0, spatial_dim, block):
+        end = min(start + block, spatial_dim)
+        # [B, S, N, T, C], scaled per block instead of scaling all of q
+        q_block = q[:, :, start:end].permute(0, 2, 3, 1, 4) * d ** -0.5
+        k_block = k[:, :, start:end].permute(0, 2, 3, 1, 4)
+        attn_temp = (q_block @ k_block.transpose(-2, -1)).float().softmax(dim=-1)
+        # rows sum to 1, so the off-diagonal sum is T - trace
+        off_diag += num_frames * attn_temp.shape[:3].numel() - attn_temp.diagonal(dim1=-2, dim2=-1).sum()
 
-    # Calculate mean for each token's attention matrix
-    # Number of off-diagonal elements per matrix is n*n - n
     num_off_diag = num_frames * num_frames - num_frames
-    mean_scores = attn_wo_diag.sum(dim=(1, 2)) / num_off_diag
-
-    enhance_scores = mean_scores.mean() * (num_frames + enhance_weight)
-    enhance_scores = enhance_scores.clamp(min=1)
+    mean_scores = off_diag / (b * spatial_dim * n * num_off_diag)
+    enhance_scores = (mean_scores * (num_frames + enhance_weight)).clamp(min=1)
     return enhance_scores
 
 import types
 class WanAttentionPatch:
-    def __init__(self, num_frames, weight):
+    def __init__(self, num_frames, weight, stride=1, compute=True, shared=None):
         self.num_frames = num_frames
         self.enhance_weight = weight
+        self.stride = stride
+        self.compute = compute
+        self.shared = {} if shared is None else shared
         
     def __get__(self, obj, objtype=None):
         # Create bound method with stored parameters
         def wrapped_attention(self_module, *args, **kwargs):
             self_module.num_frames = self.num_frames
             self_module.enhance_weight = self.enhance_weight
+            self_module.feta_stride = self.stride
+            self_module.feta_compute = self.compute
+            self_module.feta_shared = self.shared
             return modified_wan_self_attention_forward(self_module, *args, **kwargs)
         return types.MethodType(wrapped_attention, obj)
 
 
-def patch_enhance_video(model, weight, latent_frames):
+def patch_enhance_video(model, weight, latent_frames, sample_stride=1, block_stride=1):
     if weight == 0:
         return model
 
@@ -209,8 +221,10 @@ def patch_enhance_video(model, weight, latent_frames):
     diffusion_model = model_clone.get_model_object("diffusion_model")
 
     compile_settings = getattr(model.model, "compile_settings", None)
+    # blocks in between the scoring ones take the last score of the step
+    shared = {"blocks": len(diffusion_model.blocks)}
     for idx, block in enumerate(diffusion_model.blocks):
-        patched_attn = WanAttentionPatch(latent_frames, weight).__get__(block.self_attn, block.__class__)
+        patched_attn = WanAttentionPatch(latent_frames, weight, sample_stride, idx % block_stride == 0, shared).__get__(block.self_attn, block.__class__)
         if compile_settings is not None:
             patched_attn = torch.compile(
                 patched_attn,
@@ -1,9 +1,17 @@
 # reference: https://github.com/welltop-cn/ComfyUI-TeaCache
 
+import os
+import json
+import math
 import logging
+import numpy as np
 import torch
+import folder_paths
 import comfy.model_management as mm
+import comfy.patcher_extension
 from comfy.ldm.wan.model import sinusoidal_embedding_1d
+from comfy.ldm.modules.attention import optimized_attention
+from comfy.ldm.flux.math import apply_rope
 from unittest.mock import patch
 from .utils import find_step_index_percent
 
@@ -24,9 +32,238 @@ SUPPORTED_MODELS_COEFFICIENTS = {
 
 WEIGHT_480P = -4.353462645667605e-05
 
+# first block cache: blocks that always run and the relative change of their residual that still reuses the rest
+FIRST_BLOCK_CACHE_BLOCKS = 1
+FIRST_BLOCK_CACHE_THRESH = 0.08
+
+# token cache: share of tokens recomputed between full steps, the rope'd keys/values of every
+# block are kept on device from the last full step (blocks x 2 x batch x tokens x dim) for them
+TOKEN_CACHE_RATIO = 0.25
+# share of the free VRAM (after comfy's inference reserve) the cached keys/values may take
+TOKEN_CACHE_MEMORY_FRACTION = 0.5
+
+# (end_percent, max_skip_steps, rel_l1_thresh scale) segments over the sampling run
+SCHEDULE_PRESETS = {
+    "constant": [(1.0, 3, 1.0)],
+    "conservative": [(0.15, 1, 0.5), (0.85, 2, 1.0), (1.0, 1, 0.5)],
+    "balanced": [(0.1, 1, 0.5), (0.8, 3, 1.25), (1.0, 2, 0.75)],
+    "aggressive": [(0.1, 2, 0.75), (0.85, 5, 2.0), (1.0, 3, 1.0)],
+}
+
 offload_device = mm.unet_offload_device()
 
-def patch_teacache(model, model_name, mode):
+# user-editable coefficients, written by the "calibrate" mode, checked before the built-in ones
+REGISTRY_PATH = os.path.join(folder_paths.get_user_directory(), "flow2", "teacache_coefficients.json")
+
+# calibrated thresholds aim to skip about this fraction of the steps
+CALIBRATION_TARGET_SKIP = 0.3
+
+def load_registry():
+    if not os.path.isfile(REGISTRY_PATH):
+        return {}
+    try:
+        with open(REGISTRY_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read teacache registry {REGISTRY_PATH}: {e}")
+        return {}
+
+def save_registry_entry(model_name, entry):
+    registry = load_registry()
+    registry[model_name] = entry
+    os.makedirs(os.path.dirname(REGISTRY_PATH), exist_ok=True)
+    tmp = REGISTRY_PATH + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(registry, f, indent=2)
+    os.replace(tmp, REGISTRY_PATH)
+
+def rel_l1(x, prev):
+    return ((x - prev).abs().mean() / prev.abs().mean()).item()
+
+def simulate_skips(pred, thresh, max_skip_steps):
+    # same accumulation as update_cache_state, returns the fraction of skipped steps
+    acc, skips, skipped = 0, 0, 0
+    for p in pred:
+        if skips == max_skip_steps:
+            acc, skips = 0, 0
+            continue
+        acc += p
+        if acc < thresh:
+            skips += 1
+            skipped += 1
+        else:
+            acc, skips = 0, 0
+    return skipped / max(len(pred), 1)
+
+class TeaCacheCalibration:
+    """
+    Records modulated input deltas against block residual deltas and fits the poly1d coefficients
+    """
+    def __init__(self, model_name, max_skip_steps=3, target_skip=CALIBRATION_TARGET_SKIP):
+        self.model_name = model_name
+        self.max_skip_steps = max_skip_steps
+        self.target_skip = target_skip
+        self.previous = {}
+        self.samples = [] # (percent, e delta, e0 delta, residual delta)
+        self.runs = []    # sample indices of each cond/uncond sequence, for the threshold simulation
+        self.current_run = {}
+        self.saved_samples = 0
+
+    def record(self, k, e, e0, residual, percent):
+        prev = self.previous.get(k)
+        if prev is None or percent <= prev[3]:
+            # new sampling run
+            self.current_run[k] = []
+            self.runs.append(self.current_run[k])
+        else:
+            self.current_run[k].append(len(self.samples))
+            self.samples.append((
+                percent,
+                rel_l1(e, prev[0].to(e.device)),
+                rel_l1(e0, prev[1].to(e0.device)),
+                rel_l1(residual, prev[2].to(residual.device)),
+            ))
+        self.previous[k] = (e.to(offload_device), e0.to(offload_device), residual.to(offload_device), percent)
+
+    def fit(self, mode):
+        if len(self.samples) < 5:
+            return None
+        samples = np.array(self.samples, dtype=np.float64)
+        use = samples[:, 0] >= 0.1 if mode == "retention" else np.ones(len(samples), dtype=bool)
+        x = samples[use, 2 if mode == "retention" else 1]
+        y = samples[use, 3]
+        if len(x) < 5:
+            return None
+        coefficients = np.polyfit(x, y, 4)
+
+        # largest threshold that still keeps the skipped steps around the target
+        pred = np.polyval(coefficients, samples[:, 2 if mode == "retention" else 1])
+        runs = [pred[[i for i in run if use[i]]] for run in self.runs]
+        runs = [run for run in runs if len(run)]
+        best = 0.0
+        for thresh in np.geomspace(1e-3, max(float(np.sum(np.abs(run))) for run in runs) + 1e-3, 200):
+            skipped = np.mean([simulate_skips(run, thresh, self.max_skip_steps) for run in runs])
+            if skipped > self.target_skip:
+                break
+            best = float(thresh)
+        return {"coefficients": coefficients.tolist(), "rel_l1_thresh": best}
+
+    def save(self):
+        if len(self.samples) == self.saved_samples:
+            return
+        self.saved_samples = len(self.samples)
+        entry = {"samples": len(self.samples)}
+        for mode in ("normal", "retention"):
+            fitted = self.fit(mode)
+            if fitted is None:
+                print(f"teacache calibration: not enough samples for {self.model_name} yet ({len(self.samples)})")
+                return
+            entry[mode] = fitted
+        save_registry_entry(self.model_name, entry)
+        print(f"teacache calibration saved for {self.model_name} to {REGISTRY_PATH}: " + ", ".join(f"{m} rel_l1_thresh={entry[m]['rel_l1_thresh']:.3f}" for m in ("normal", "retention")))
+
+RESIDUAL_DTYPES = {
+    "default": None,
+    "fp16": torch.float16,
+    "fp8": getattr(torch, "float8_e4m3fn", None),
+}
+
+class TeaCacheState:
+    """
+    TeaCache state of one sampling run, one entry per (cond_or_uncond, batch element)
+    """
+    def __init__(self, residency="host", residual_dtype=None):
+        self.entries = {}
+        self.residency = residency
+        self.residual_dtype = residual_dtype
+        self.computed = 0
+        self.skipped = 0
+        self.partial = 0 # token cache steps that recomputed only some tokens
+        self.split = 0 # steps that ran the blocks for only part of the batch
+        self.token_kv = {} # token cache: per-block [k, v] of the last full step, per (cond_or_uncond, batch)
+        self.token_kv_refused = False
+        self.transfer_bytes = 0 # actually moved between host and device
+        self.baseline_bytes = 0 # what full precision host storage would have moved
+
+    def entry(self, k, j):
+        if (k, j) not in self.entries:
+            self.entries[(k, j)] = {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None, 'skip_steps': 0, 'previous_first_residual': None, 'previous_input': None}
+        return self.entries[(k, j)]
+
+    def store(self, residual):
+        """
+        Residual as kept between steps: (data, scale, dtype), optionally compressed and on the host
+        """
+        self.baseline_bytes += residual.numel() * residual.element_size()
+        dtype, scale = residual.dtype, None
+        data = residual
+        if self.residual_dtype is not None and self.residual_dtype != dtype:
+            if self.residual_dtype.itemsize == 1:
+                # fp8 needs a scale, e4m3 tops out at 448
+                scale = (residual.abs().amax().float() / 448).clamp(min=1e-12)
+                data = (residual.float() / scale).to(self.residual_dtype)
+            else:
+                data = residual.to(self.residual_dtype)
+        if self.residency == "host":
+            data = data.to(offload_device)
+            self.transfer_bytes += data.numel() * data.element_size()
+        return data, scale, dtype
+
+    def load(self, stored, device):
+        data, scale, dtype = stored
+        self.baseline_bytes += data.numel() * dtype.itemsize
+        if data.device != device:
+            self.transfer_bytes += data.numel() * data.element_size()
+        data = data.to(device)
+        if scale is not None:
+            return (data.float() * scale.to(device)).to(dtype)
+        return data.to(dtype)
+
+    def __repr__(self):
+        mb = 1024 ** 2
+        return (
+            f"TeaCacheState(computed={self.computed}, skipped={self.skipped}, partial={self.partial}, split={self.split}, residency={self.residency}, "
+            f"residual_dtype={self.residual_dtype}, transfers={self.transfer_bytes / mb:.1f} MB vs {self.baseline_bytes / mb:.1f} MB full precision on host)"
+        )
+
+class TeaCacheSchedule:
+    """
+    Max consecutive skips and threshold scale as a function of the step percent
+    """
+    def __init__(self, segments):
+        self.segments = sorted(segments)
+
+    @classmethod
+    def preset(cls, name):
+        return cls(SCHEDULE_PRESETS[name])
+
+    def at(self, percent):
+        for end_percent, max_skip_steps, thresh_scale in self.segments:
+            if percent <= end_percent:
+                return max_skip_steps, thresh_scale
+        return self.segments[-1][1:]
+
+    def __repr__(self):
+        return f"TeaCacheSchedule({self.segments})"
+
+def teacache_outer_sample_wrapper(executor, *args, **kwargs):
+    # the guider's model_options are a per-run copy, a fresh state here is never shared between runs
+    guider = executor.class_obj
+    transformer_options = guider.model_options.setdefault("transformer_options", {})
+    state = TeaCacheState(transformer_options.get("residency", "host"), transformer_options.get("residual_dtype"))
+    transformer_options["teacache_state"] = state
+    out = executor(*args, **kwargs)
+    print(f"teacache: {state}")
+    return out
+
+def get_model_coefficients(model_name, mode):
+    """
+    (coefficients, rel_l1_thresh, source) from the registry or the built-in presets
+    """
+    entry = load_registry().get(model_name, {}).get(mode)
+    if entry is not None:
+        return entry["coefficients"], entry["rel_l1_thresh"], "registry"
+
     model_type = None
     if all(k in model_name for k in ("i2v", "14b", "720p")):
         model_type = "i2v_720p_14B"
@@ -41,23 +278,52 @@ def patch_teacache(model, model_name, mode):
         model_type = "i2v_480p_14B"
 
     if model_type is None:
-        print("teacache model_type is None")
-        return model
+        return None
+    coefficients, rel_l1_thresh = SUPPORTED_MODELS_COEFFICIENTS[mode][model_type]
+    return coefficients, rel_l1_thresh, model_type
+
+def patch_teacache(model, model_name, mode, residency="host", residual_dtype="default", schedule="constant"):
+    calibration = None
+    first_block_cache = 0
+    token_cache = 0
+    if mode == "token":
+        # no per-model coefficients, the block inputs pick the tokens
+        token_cache = TOKEN_CACHE_RATIO
+        coefficients, rel_l1_thresh = None, None
+        print(f"patched token cache, recomputed tokens: {token_cache:.0%}")
+    elif mode == "first_block":
+        # no per-model coefficients, works for every Wan variant
+        first_block_cache = FIRST_BLOCK_CACHE_BLOCKS
+        coefficients, rel_l1_thresh = None, FIRST_BLOCK_CACHE_THRESH
+        print(f"patched first block cache, blocks: {first_block_cache}, rel_l1_thresh: {rel_l1_thresh}")
+    elif mode == "calibrate":
+        # run every step in full and record, nothing is skipped
+        calibration = TeaCacheCalibration(model_name)
+        coefficients, rel_l1_thresh = [0.0], 0.0
+        print(f"patched teacache calibration for {model_name}, coefficients are saved after each run")
+    else:
+        found = get_model_coefficients(model_name, mode)
+        if found is None:
+            print("teacache model_type is None, run the \"calibrate\" mode once to add this model")
+            return model
+        coefficients, rel_l1_thresh, model_type = found
+        print(f"patched teacache mode: {mode}, model_type: {model_type}, rel_l1_thresh: {rel_l1_thresh}")
 
     new_model = model.clone()
-    
-    coefficients = SUPPORTED_MODELS_COEFFICIENTS[mode][model_type][0]
-    rel_l1_thresh = SUPPORTED_MODELS_COEFFICIENTS[mode][model_type][1]
-
-    print(f"patched teacache mode: {mode}, model_type: {model_type}, rel_l1_thresh: {rel_l1_thresh}")
 
     if 'transformer_options' not in new_model.model_options:
         new_model.model_options['transformer_options'] = {}    
             
+    schedule = TeaCacheSchedule.preset(schedule)
     new_model.model_options["transformer_options"]["max_skip_steps"] = 3
     new_model.model_options["transformer_options"]["coefficients"] = coefficients
     new_model.model_options["transformer_options"]["rel_l1_thresh"] = rel_l1_thresh
     new_model.model_options["transformer_options"]["use_ret_mode"] = "retention" in mode
+    new_model.model_options["transformer_options"]["teacache_calibration"] = calibration
+    new_model.model_options["transformer_options"]["first_block_cache"] = first_block_cache
+    new_model.model_options["transformer_options"]["token_cache"] = token_cache
+    new_model.model_options["transformer_options"]["residency"] = residency
+    new_model.model_options["transformer_options"]["residual_dtype"] = RESIDUAL_DTYPES[residual_dtype]
 
     diffusion_model = new_model.get_model_object("diffusion_model")
 
@@ -66,29 +332,43 @@ def patch_teacache(model, model_name, mode):
         forward_orig=teacache_wanmodel_forward.__get__(diffusion_model, diffusion_model.__class__)
     )
 
+    # samplers that bypass the outer sample wrapper get one state per sigmas tensor instead
+    fallback = {"sigmas": None, "state": None}
+
     def unet_wrapper_function(model_function, kwargs):
         input = kwargs["input"]
         timestep = kwargs["timestep"]
 
         c = kwargs["c"]
-        cond_or_uncond = kwargs["cond_or_uncond"]
         use_ret_mode = c["transformer_options"]["use_ret_mode"]
 
         sigmas = c["transformer_options"]["sample_sigmas"]
         current_step, current_percent = find_step_index_percent(sigmas, timestep)
 
-        if current_step == 0:
-            if (1 in cond_or_uncond) and hasattr(diffusion_model, 'teacache_state'):
-                delattr(diffusion_model, 'teacache_state')
+        if c["transformer_options"].get("teacache_state") is None:
+            if fallback["sigmas"] is not sigmas:
+                fallback["sigmas"], fallback["state"] = sigmas, TeaCacheState(residency, RESIDUAL_DTYPES[residual_dtype])
+            c["transformer_options"]["teacache_state"] = fallback["state"]
 
         c["transformer_options"]["current_percent"] = current_percent
+        max_skip_steps, thresh_scale = schedule.at(current_percent)
+        c["transformer_options"]["max_skip_steps"] = max_skip_steps
+        if rel_l1_thresh is not None:
+            c["transformer_options"]["rel_l1_thresh"] = rel_l1_thresh * thresh_scale
         if use_ret_mode and current_percent < 0.1: # retention
             c["transformer_options"]["enable_teacache"] = False
+        if calibration is not None:
+            c["transformer_options"]["enable_teacache"] = False
 
         with context:
-            return model_function(input, timestep, **c)
+            out = model_function(input, timestep, **c)
+
+        if calibration is not None and current_step == len(sigmas) - 2:
+            calibration.save()
+        return out
 
     new_model.set_model_unet_function_wrapper(unet_wrapper_function)
+    new_model.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.OUTER_SAMPLE, "teacache", teacache_outer_sample_wrapper)
 
     return new_model
 
@@ -98,6 +378,74 @@ def poly1d(coefficients, x):
         result += coeff * (x ** (len(coefficients) - 1 - i))
     return result
 
+def gather_tokens(t, idx):
+    """
+    Tokens of t (B or 1, L, ...) at per batch element indices idx (B, k)
+    """
+    t = t.expand(idx.shape[0], *t.shape[1:])
+    index = idx.view(*idx.shape, *([1] * (t.ndim - 2))).expand(-1, -1, *t.shape[2:])
+    return torch.gather(t, 1, index)
+
+def token_kv_fits(nbytes, device):
+    """
+    Whether the token cache keys/values fit its share of the free memory on device
+    """
+    free = mm.get_free_memory(device) - mm.minimum_inference_memory()
+    return nbytes <= TOKEN_CACHE_MEMORY_FRACTION * max(0, free)
+
+def capture_block_kv(blocks, freqs, kv):
+    """
+    Forward hooks that keep the rope'd keys and the values of every block's self-attention in kv
+    """
+    handles = []
+    for i, block in enumerate(blocks):
+        attn = block.self_attn
+        def keep_k(module, args, k, i=i, attn=attn):
+            b, s = k.shape[:2]
+            # skip layer guidance may run a block on the last (cond) row only
+            rows_freqs = freqs if freqs.shape[0] == 1 else freqs[-b:]
+            k = k.view(b, s, attn.num_heads, attn.head_dim)
+            kv[i][0] = apply_rope(k, k, rows_freqs)[1].view(b, s, -1)
+        def keep_v(module, args, v, i=i):
+            kv[i][1] = v
+        handles.append(attn.norm_k.register_forward_hook(keep_k))
+        handles.append(attn.v.register_forward_hook(keep_v))
+    return handles
+
+def token_self_attention(attn, x, k_cache, v_cache, idx, freqs):
+    """
+    WanSelfAttention for the token subset x (at idx) against the cached keys/values of the whole sequence
+    """
+    b, s, n, d = *x.shape[:2], attn.num_heads, attn.head_dim
+    q = attn.norm_q(attn.q(x)).view(b, s, n, d)
+    k = attn.norm_k(attn.k(x)).view(b, s, n, d)
+    q, k = apply_rope(q, k, freqs)
+
+    # the recomputed tokens replace their own keys/values, the rest stays from the last full step
+    index = idx.unsqueeze(-1).expand(-1, -1, n * d)
+    k_cache.scatter_(1, index, k.view(b, s, n * d).to(k_cache.dtype))
+    v_cache.scatter_(1, index, attn.v(x).to(v_cache.dtype))
+    x = optimized_attention(q.view(b, s, n * d), k_cache, v_cache, heads=n)
+    x = attn.o(x)
+
+    # the enhance (FETA) score needs every frame, keep the one of the last full step
+    feta_shared = getattr(attn, "feta_shared", None)
+    if feta_shared is not None and feta_shared.get("score") is not None:
+        x = x * feta_shared["score"]
+    return x
+
+def token_block_forward(block, x, k_cache, v_cache, idx, e, freqs, context):
+    """
+    WanAttentionBlock.forward for the token subset x
+    """
+    e = (block.modulation.to(dtype=x.dtype, device=x.device) + e).chunk(6, dim=1)
+    y = token_self_attention(block.self_attn, block.norm1(x) * (1 + e[1]) + e[0], k_cache, v_cache, idx, freqs)
+    x = x + y * e[2]
+    x = x + block.cross_attn(block.norm3(x), context)
+    y = block.ffn(block.norm2(x) * (1 + e[4]) + e[3])
+    x = x + y * e[5]
+    return x
+
 def teacache_wanmodel_forward(
         self,
         x,
@@ -135,15 +483,12 @@ def teacache_wanmodel_forward(
 
 
     # enable teacache
-    modulated_inp = e0.to(offload_device) if use_ret_mode else e.to(offload_device)
-    if not hasattr(self, 'teacache_state'):
-        self.teacache_state = {
-            0: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None, 'skip_steps': 0},
-            1: {'should_calc': True, 'accumulated_rel_l1_distance': 0, 'previous_modulated_input': None, 'previous_residual': None, 'skip_steps': 0}
-        }
+    state = transformer_options["teacache_state"]
+    first_block_cache = transformer_options.get("first_block_cache", 0)
+    token_cache = transformer_options.get("token_cache", 0)
 
     def update_cache_state(cache, modulated_inp):
-        if cache['skip_steps'] == max_skip_steps:
+        if cache['skip_steps'] >= max_skip_steps:
             cache['should_calc'] = True
             cache['accumulated_rel_l1_distance'] = 0
             cache['skip_steps'] = 0
@@ -162,27 +507,22 @@ def teacache_wanmodel_forward(
                 cache['accumulated_rel_l1_distance'] = 0
                 cache['skip_steps'] = 0
         cache['previous_modulated_input'] = modulated_inp
-        
-    b = int(len(x) / len(cond_or_uncond))
-
-    for i, k in enumerate(cond_or_uncond):
-        update_cache_state(self.teacache_state[k], modulated_inp[i*b:(i+1)*b])
 
-    if enable_teacache:
-        should_calc = False
-        for k in cond_or_uncond:
-            should_calc = (should_calc or self.teacache_state[k]['should_calc'])
-    else:
-        should_calc = True
+    def update_first_block_state(cache, first_residual):
+        # compare against the first block residual of the last step that ran in full
+        previous = cache['previous_first_residual']
+        if cache['skip_steps'] >= max_skip_steps or previous is None:
+            cache['should_calc'] = True
+            return
+        previous = state.load(previous, first_residual.device)
+        cache['should_calc'] = ((first_residual - previous).abs().mean() / previous.abs().mean()).item() >= rel_l1_thresh
 
     patches_replace = transformer_options.get("patches_replace", {})
     blocks_replace = patches_replace.get("dit", {})
-    if not should_calc:
-        for i, k in enumerate(cond_or_uncond):
-            x[i*b:(i+1)*b] += self.teacache_state[k]['previous_residual'].to(x.device)
-    else:
-        ori_x = x.clone()
-        for i, block in enumerate(self.blocks):
+
+    def run_blocks(x, start, end, freqs=freqs, e0=e0, context=context, transformer_options=transformer_options):
+        for i in range(start, end):
+            block = self.blocks[i]
             if ("double_block", i) in blocks_replace:
                 def block_wrap(args):
                     out = {}
@@ -192,8 +532,129 @@ def teacache_wanmodel_forward(
                 x = out["img"]
             else:
                 x = block(x, e=e0, freqs=freqs, context=context)
-        for i, k in enumerate(cond_or_uncond):
-            self.teacache_state[k]['previous_residual'] = (x - ori_x)[i*b:(i+1)*b].to(offload_device)
+        return x
+
+    b = int(len(x) / len(cond_or_uncond))
+
+    # every batch element (seed / prompt) keeps its own state
+    entries = [state.entry(k, j) for k in cond_or_uncond for j in range(b)]
+    start = 0
+    if first_block_cache > 0:
+        # the first blocks always run, their residual decides about the rest
+        start = min(first_block_cache, len(self.blocks))
+        ori_x = x.clone()
+        x = run_blocks(x, 0, start)
+        first_residual = x - ori_x
+        for row, cache in enumerate(entries):
+            update_first_block_state(cache, first_residual[row:row + 1])
+    elif token_cache > 0:
+        kv_key = (tuple(cond_or_uncond), b)
+        kv = state.token_kv.get(kv_key)
+        # blocks run on fewer rows (skip layer guidance) left no keys/values for the others
+        kv_usable = kv is not None and all(k is not None and k.shape[0] == len(entries) for k, _ in kv)
+        for cache in entries:
+            # every max_skip_steps + 1 steps all tokens are refreshed
+            cache['should_calc'] = cache['skip_steps'] >= max_skip_steps or cache['previous_input'] is None or not kv_usable
+    else:
+        modulated_inp = e0 if use_ret_mode else e
+        if state.residency == "host":
+            modulated_inp = modulated_inp.to(offload_device)
+        for row, cache in enumerate(entries):
+            update_cache_state(cache, modulated_inp[row:row + 1])
+
+    if enable_teacache:
+        calc_rows = [row for row, cache in enumerate(entries) if cache['should_calc'] or cache['previous_residual'] is None]
+        if first_block_cache == 0 and calc_rows:
+            # only first_block decides per batch element (cond / uncond / seed), from its residual.
+            # normal/retention decide from the timestep embedding every element shares, and the
+            # token cache works on the whole batch, so they refresh it together
+            calc_rows = list(range(len(entries)))
+    else:
+        calc_rows = list(range(len(entries)))
+
+    if not calc_rows and token_cache > 0:
+        # recompute the tokens whose block input changed most since the last full step, the rest reuses its residual
+        state.partial += 1
+        previous_input = torch.cat([state.load(cache['previous_input'], x.device) for cache in entries])
+        change = (x - previous_input).abs().mean(-1) / previous_input.abs().mean(-1).clamp(min=1e-6)
+        idx = change.topk(max(1, math.ceil(x.shape[1] * token_cache)), dim=1).indices
+        index = idx.unsqueeze(-1).expand(-1, -1, x.shape[-1])
+        x_tokens = gather_tokens(x, idx)
+        freqs_tokens = gather_tokens(freqs, idx)
+        out_tokens = x_tokens
+        for i, block in enumerate(self.blocks):
+            k_cache, v_cache = kv[i]
+            if ("double_block", i) in blocks_replace:
+                def block_wrap(args, k_cache=k_cache, v_cache=v_cache, block=block):
+                    # skip layer guidance may pass only the last (cond) row
+                    rows = args["img"].shape[0]
+                    return {"img": token_block_forward(block, args["img"], k_cache[-rows:], v_cache[-rows:], idx[-rows:], args["vec"], args["pe"], args["txt"])}
+                out_tokens = blocks_replace[("double_block", i)]({"img": out_tokens, "txt": context, "vec": e0, "pe": freqs_tokens}, {"original_block": block_wrap, "transformer_options": transformer_options})["img"]
+            else:
+                out_tokens = token_block_forward(block, out_tokens, k_cache, v_cache, idx, e0, freqs_tokens, context)
+        residual = torch.cat([state.load(cache['previous_residual'], x.device) for cache in entries])
+        residual.scatter_(1, index, out_tokens - x_tokens)
+        x = x + residual
+        for row, cache in enumerate(entries):
+            cache['previous_residual'] = state.store(residual[row:row + 1])
+            cache['skip_steps'] += 1
+    elif not calc_rows:
+        state.skipped += 1
+        x += torch.cat([state.load(cache['previous_residual'], x.device) for cache in entries])
+        if first_block_cache > 0:
+            for cache in entries:
+                cache['skip_steps'] += 1
+    else:
+        ori_x = x.clone()
+        if len(calc_rows) < len(entries):
+            # only some elements need the blocks, run them on that part of the batch and reuse the rest
+            state.split += 1
+            index = torch.tensor(calc_rows, device=x.device)
+            rows_freqs = freqs if freqs is None or freqs.shape[0] == 1 else freqs[index]
+            rows_options = dict(transformer_options, cond_or_uncond=list(dict.fromkeys(cond_or_uncond[row // b] for row in calc_rows)))
+            rows_x = x[index]
+            rows_residual = run_blocks(rows_x, start, len(self.blocks), freqs=rows_freqs, e0=e0[index], context=context[index], transformer_options=rows_options) - rows_x
+            computed = dict(zip(calc_rows, rows_residual.split(1)))
+            residual = torch.cat([computed[row] if row in computed else state.load(cache['previous_residual'], x.device) for row, cache in enumerate(entries)])
+            x = x + residual
+        else:
+            state.computed += 1
+            handles = []
+            if token_cache > 0:
+                # the keys/values of the last full step are replaced, not kept next to the new ones
+                state.token_kv.pop(kv_key, None)
+                kv_bytes = len(self.blocks) * 2 * x.numel() * x.element_size()
+                if token_kv_fits(kv_bytes, x.device):
+                    kv = [[None, None] for _ in self.blocks]
+                    state.token_kv[kv_key] = kv
+                    handles = capture_block_kv(self.blocks, freqs, kv)
+                elif not state.token_kv_refused:
+                    state.token_kv_refused = True
+                    print(f"token cache: keys/values need {kv_bytes / 1024 ** 2:.0f} MB, over {TOKEN_CACHE_MEMORY_FRACTION:.0%} of the free VRAM, running every step in full")
+            try:
+                x = run_blocks(x, start, len(self.blocks))
+            finally:
+                for handle in handles:
+                    handle.remove()
+            residual = x - ori_x
+            computed = dict(zip(calc_rows, residual.split(1)))
+        for row, cache in enumerate(entries):
+            if row not in computed:
+                # split batch (first_block only), this element reused its residual
+                cache['skip_steps'] += 1
+                continue
+            cache['previous_residual'] = state.store(computed[row])
+            if first_block_cache > 0:
+                cache['previous_first_residual'] = state.store(first_residual[row:row + 1])
+                cache['skip_steps'] = 0
+            if token_cache > 0:
+                cache['previous_input'] = state.store(ori_x[row:row + 1])
+                cache['skip_steps'] = 0
+
+        calibration = transformer_options.get("teacache_calibration")
+        if calibration is not None:
+            for row, (k, j) in enumerate((k, j) for k in cond_or_uncond for j in range(b)):
+                calibration.record((k, j), e[row:row + 1], e0[row:row + 1], residual[row:row + 1], transformer_options.get("current_percent", 0))
 
     # head
     x = self.head(x, e)
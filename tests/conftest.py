@@ -0,0 +1,28 @@
+# The repo root is a ComfyUI custom node package whose __init__ loads every node (and with
+# them all of ComfyUI). Register it without running that, so tests import single modules.
+import os
+import sys
+import types
+import importlib
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = os.path.basename(ROOT)
+
+if PACKAGE not in sys.modules:
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [ROOT]
+    package.__file__ = os.path.join(ROOT, "__init__.py")
+    sys.modules[PACKAGE] = package
+
+@pytest.fixture
+def repo_module():
+    def load(name):
+        try:
+            return importlib.import_module(f"{PACKAGE}.{name}")
+        except ModuleNotFoundError as e:
+            if not (e.name or "").startswith("comfy"):
+                raise
+            pytest.skip(f"needs ComfyUI ({e.name})")
+    return load
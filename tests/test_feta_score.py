@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+def video_qk(seed, frames=9, tokens=480, heads=8, head_dim=32):
+    # one base per spatial token plus a per-token amount of motion, from static to fast
+    g = torch.Generator().manual_seed(seed)
+    base = torch.randn(1, 1, tokens, heads, head_dim, generator=g)
+    motion = torch.rand(1, 1, tokens, heads, 1, generator=g).pow(2) * 3
+    drift = torch.randn(1, frames, tokens, heads, head_dim, generator=g) * motion
+    return (base + drift).flatten(1, 2)
+
+@pytest.mark.parametrize("stride", [2, 4])
+@pytest.mark.parametrize("enhance_weight", [1.0, 4.0])
+def test_subsampled_score_close_to_full(repo_module, stride, enhance_weight):
+    patch = repo_module("model_patcher.patch")
+    q, k = video_qk(0), video_qk(1)
+    full = patch.get_feta_scores(q, k, 9, enhance_weight)
+    subsampled = patch.get_feta_scores(q, k, 9, enhance_weight, stride)
+    assert ((subsampled - full).abs() / full).item() < 0.01
+
+def test_blocked_score_matches_one_block(repo_module, monkeypatch):
+    patch = repo_module("model_patcher.patch")
+    q, k = video_qk(0), video_qk(1)
+    full = patch.get_feta_scores(q, k, 9, 2.0)
+    monkeypatch.setattr(patch, "FETA_BLOCK_BYTES", 4096)
+    torch.testing.assert_close(patch.get_feta_scores(q, k, 9, 2.0), full)
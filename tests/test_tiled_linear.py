@@ -0,0 +1,29 @@
+import gguf
+import numpy as np
+import torch
+
+def make_linear(ops, out_features=200, in_features=256, tile_rows=48):
+    rng = np.random.default_rng(0)
+    qtype = gguf.GGMLQuantizationType.Q8_0
+    raw = gguf.quants.quantize(rng.standard_normal((out_features, in_features), dtype=np.float32), qtype)
+    weight = ops.GGMLTensor(torch.from_numpy(raw), tensor_type=qtype, tensor_shape=torch.Size((out_features, in_features)))
+    layer = ops.GGMLOps().Linear(in_features, out_features)
+    layer.weight = torch.nn.Parameter(weight, requires_grad=False)
+    layer.bias = torch.nn.Parameter(torch.from_numpy(rng.standard_normal(out_features, dtype=np.float32)), requires_grad=False)
+    layer.tile_rows = tile_rows
+    return layer
+
+def test_tiled_matches_full_weight(repo_module):
+    ops, dequant = repo_module("gguf.ops"), repo_module("gguf.dequant")
+    layer = make_linear(ops)
+    assert layer.can_tile()
+
+    x = torch.randn(3, 7, layer.in_features)
+    full = torch.nn.functional.linear(x, dequant.dequantize_tensor(layer.weight, torch.float32), layer.bias)
+    torch.testing.assert_close(layer.forward_ggml_tiled(x), full, rtol=1e-5, atol=1e-5)
+
+def test_weight_cache_keeps_weights_whole(repo_module):
+    ops, cache = repo_module("gguf.ops"), repo_module("gguf.cache")
+    layer = make_linear(ops)
+    layer.weight_cache = cache.DequantCache(1)
+    assert not layer.can_tile()